@@ -1,10 +1,36 @@
+import re
 import sys
+import json
+import time
+import queue
+import random
+import asyncio
+import struct
+import hashlib
 import logging
+import itertools
+import threading
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 
-from .utils import (Connection, UserData, Snapshot, VERSION, DEFAULT_FORMAT)
+from .utils import (Connection, AsyncConnection, FramedConnection, UserData,
+                    Snapshot, FlatSnapshot, EndSession, Pipeline,
+                    LastSnapshot, Compression, Have, Hello, FLAGS, VERSION,
+                    PROTOCOL_VERSION, CHUNK_SIZE, DEFAULT_FORMAT, compress,
+                    message_parts, message_size)
+
+
+DIGEST_BATCH = 64  # snapshots to ask the server about at a time
+# times to retry connecting to a busy server, and the longest to wait before
+#  retrying
+BUSY_RETRIES = 8
+MAX_BACKOFF = 30
+SAMPLE_PATTERN = '*.mind*'
+ENCODINGS = ('protobuf', 'flat')     # see protocol.FlatSnapshot
+# files kept next to sample files, which aren't samples themselves
+SIDECAR_SUFFIXES = ('.idx', '.gzidx', '.checkpoint')
 
 
 def logger_init(name):
@@ -27,10 +53,36 @@ def cli():
 @click.option('-p', '--port', type=int)
 @click.argument('path')
 @click.option('-f', '--format')
-def upload_sample(host, port, path, format):
+@click.option('-s', '--session', is_flag=True,
+              help='Send all messages over a single connection')
+@click.option('-w', '--window', type=int, default=1,
+              help='Max. number of unacknowledged snapshots (implies -s)')
+@click.option('-W', '--workers', type=int, default=1,
+              help='Number of parallel connections (implies -s)')
+@click.option('-r', '--resume', is_flag=True,
+              help='Skip snapshots uploaded before (implies -s)')
+@click.option('-c', '--compression',
+              help='Codecs to compress snapshots with, e.g. zstd,zlib '
+                   '(implies -s)')
+@click.option('-d', '--dedup', is_flag=True,
+              help='Skip snapshots the server already holds (implies -s)')
+@click.option('-a', '--read-ahead', type=int, default=0,
+              help='Number of snapshots to decompress in the background '
+                   '(ignored for uncompressed samples)')
+@click.option('-P', '--protocol', type=int, default=PROTOCOL_VERSION,
+              help='Latest protocol version to offer the server (with -s)')
+@click.option('-b', '--batch', type=int, default=1,
+              help='Number of snapshots to send per message (implies -s)')
+@click.option('-e', '--encoding', type=click.Choice(ENCODINGS),
+              default='protobuf', help='Encoding to send snapshots in')
+def upload_sample(host, port, path, format, session, window, workers,
+                  resume, compression, dedup, read_ahead, protocol, batch,
+                  encoding):
     logger_init('client')
     try:
-        _upload_sample(host, port, path, format)
+        _upload_sample(host, port, path, format, session, window, workers,
+                       resume, compression, dedup, read_ahead, protocol,
+                       batch, encoding)
     except Exception as error:
         if 'Temporary failure in name resolution' in str(error):
             error = f'unknown host name "{host}"'
@@ -39,64 +91,729 @@ def upload_sample(host, port, path, format):
         return 1
 
 
-def _upload_sample(host, port, path, format=None):
+@cli.command()
+@click.option('-h', '--host')
+@click.option('-p', '--port', type=int)
+@click.argument('path')
+@click.option('-g', '--pattern', default=SAMPLE_PATTERN,
+              help='Files to upload in the directory, as a glob pattern')
+@click.option('-j', '--jobs', type=int, default=4,
+              help='Max. number of files to upload at a time')
+@click.option('-f', '--format')
+@click.option('-s', '--session', is_flag=True,
+              help='Send all messages over a single connection')
+@click.option('-w', '--window', type=int, default=1,
+              help='Max. number of unacknowledged snapshots (implies -s)')
+@click.option('-r', '--resume', is_flag=True,
+              help='Skip snapshots uploaded before (implies -s)')
+@click.option('-c', '--compression',
+              help='Codecs to compress snapshots with, e.g. zstd,zlib '
+                   '(implies -s)')
+@click.option('-d', '--dedup', is_flag=True,
+              help='Skip snapshots the server already holds (implies -s)')
+def upload_dir(host, port, path, pattern, jobs, format, session, window,
+               resume, compression, dedup):
+    logger_init('client')
+    try:
+        results = _upload_dir(host, port, path, pattern, jobs, format,
+                              session=session, window=window, resume=resume,
+                              compression=compression, dedup=dedup)
+    except Exception as error:
+        print(f'ERROR: {error}', file=sys.stderr)
+        logging.critical(f'{error}')
+        return 1
+    if any(isinstance(result, Exception) for result in results.values()):
+        return 1
+
+
+class Checkpoint:
+    ''' Keeps track of the last snapshot up to which a sample file has been
+        acknowledged by the server, along with its offset in the file and
+        its datetime '''
+    save_interval = 1   # seconds
+
+    def __init__(self, path):
+        self.path = Path(f'{path}.checkpoint')
+        self.reset()
+        self.saved, self.saved_at = self.position(), 0
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.snapshot, self.offset, self.datetime = 0, None, 0
+        self.offsets, self.acked = {}, set()
+
+    def position(self):
+        return self.snapshot, self.offset, self.datetime
+
+    def load(self):
+        if self.path.exists():
+            checkpoint = json.loads(self.path.read_text())
+            # checkpoints saved before datetimes were can't be confirmed
+            self.snapshot, self.offset, self.datetime = \
+                checkpoint['snapshot'], checkpoint['offset'], \
+                checkpoint.get('datetime', 0)
+            self.saved = self.position()
+
+    def save(self):
+        self.path.write_text(json.dumps({'snapshot': self.snapshot,
+                                         'offset': self.offset,
+                                         'datetime': self.datetime}))
+        self.saved, self.saved_at = self.position(), time.monotonic()
+
+    def track(self, i, offset, datetime=0):
+        # offset of the data following snapshot #i in the sample file
+        with self.lock:
+            self.offsets[i] = offset, datetime
+
+    def acknowledge(self, i):
+        # snapshots may be acknowledged out of order by parallel workers, so
+        #  only advance past those which have all been acknowledged
+        with self.lock:
+            self.acked.add(i)
+            while self.snapshot + 1 in self.acked:
+                self.snapshot += 1
+                self.acked.remove(self.snapshot)
+                self.offset, self.datetime = self.offsets.pop(self.snapshot)
+            if time.monotonic() - self.saved_at > self.save_interval:
+                self.save()
+
+    def close(self):
+        # saves how far an interrupted upload got; one which got nowhere
+        #  leaves the checkpoint of the previous one as it is
+        with self.lock:
+            if self.position() != self.saved:
+                self.save()
+
+    def complete(self):
+        # nothing left to resume once every snapshot was acknowledged
+        with self.lock:
+            if self.offsets:
+                self.save()
+            else:
+                self.path.unlink(missing_ok=True)
+
+
+@cli.command()
+@click.argument('path')
+@click.option('-f', '--format')
+def index_sample(path, format):
+    logger_init('client')
+    try:
+        snapshots = _index_sample(path, format)
+        print(f'Indexed {snapshots} snapshots')
+    except Exception as error:
+        print(f'ERROR: {error}', file=sys.stderr)
+        logging.critical(f'{error}')
+        return 1
+
+
+def _index_sample(path, format=None):
+    format = _sample_format(path, format)
+    reader_module = __import__('bci.readers', globals(), locals(), [format])
+    reader_module = getattr(reader_module, format)
+    if not hasattr(reader_module, 'build_index'):
+        raise Exception(f'the {format} format does not support indexing')
+    return len(reader_module.build_index(path))
+
+
+@cli.command()
+@click.argument('path')
+@click.argument('destination', required=False)
+@click.option('-f', '--format')
+@click.option('-c', '--codec', default='zlib',
+              help='Codec to compress snapshot blocks with')
+def convert_sample(path, destination, format, codec):
+    logger_init('client')
+    try:
+        snapshots = _convert_sample(path, destination, format, codec)
+        print(f'Converted {snapshots} snapshots')
+    except Exception as error:
+        print(f'ERROR: {error}', file=sys.stderr)
+        logging.critical(f'{error}')
+        return 1
+
+
+def _convert_sample(path, destination=None, format=None, codec='zlib'):
+    from .readers import mindx
+    if not destination:
+        destination = re.sub(r'(\.mind)?(\.gz)?$', '', path) + '.mindx'
+    format = _sample_format(path, format)
+    reader_module = __import__('bci.readers', globals(), locals(), [format])
+    reader = getattr(reader_module, format).reader_cls(path)
+    with reader:
+        return mindx.convert(reader, destination, codec)
+
+
+def _sample_format(path, format):
+    if format:
+        return format
+    if str(path).endswith('.mindx'):
+        return 'mindx'
+    return DEFAULT_FORMAT
+
+
+def _log_ack(title, ack_msg):
+    ack_msg = ack_msg.decode()
+    if 'ERROR' in ack_msg:
+        print(f'{title}: {ack_msg}', file=sys.stderr)
+        logging.warning(f'{ack_msg}')
+        return False
+    print(f'{title}: {ack_msg}')
+    logging.info(f'{title}: {ack_msg}')
+    return True
+
+
+def _connect(host, port, message):
+    # connects and sends the connection's first message, returning the
+    #  connection along with the server's answer; servers too busy to serve
+    #  the connection answer with the time to wait before retrying, which
+    #  grows (with some jitter) with every retry
+    for attempt in itertools.count():
+        connection = Connection.connect(host, port)
+        try:
+            connection.send_message(message)
+        except (ConnectionResetError, BrokenPipeError) as error:
+            # a busy server answers before reading a large first message, and
+            #  may reset the connection before all of it was sent; its answer
+            #  is still there to read, and any other reset is a real failure
+            try:
+                answer = connection.receive_message()
+            except Exception:
+                answer = b''
+            if not answer.startswith(b'BUSY'):
+                connection.close()
+                raise error
+        else:
+            answer = connection.receive_message()
+        if not answer.startswith(b'BUSY'):
+            return connection, answer
+        connection.close()
+        time.sleep(_backoff(answer, attempt))
+
+
+def _backoff(answer, attempt):
+    if attempt == BUSY_RETRIES:
+        raise Exception('server is busy')
+    retry_after = float(answer.split()[-1])
+    delay = min(retry_after * 2 ** attempt, MAX_BACKOFF) * \
+        random.uniform(1, 1.5)
+    logging.warning(f'server is busy, retrying in {delay:.1f}s')
+    return delay
+
+
+def _open_session(host, port, user_id, protocol=PROTOCOL_VERSION):
+    # opens the session by offering the latest protocol version; servers
+    #  which only speak v1 reject the offer, in which case the session
+    #  carries on with v1 messages
+    connection, answer = _connect(
+        host, port, Hello(user_id, range(1, protocol + 1)).serialize())
+    answer = answer.decode()
+    if not answer.isdigit() or int(answer) < 2:
+        if protocol >= 2:
+            logging.warning('server does not support protocol v2')
+        return connection
+    return FramedConnection(connection)
+
+
+def _request_pipelining(connection, user_id, window):
+    # servers which don't support pipelining reject the request, in which
+    #  case we fall back to waiting for each snapshot's ack in turn; in v2,
+    #  every frame is sequenced anyway
+    if isinstance(connection, FramedConnection):
+        return window
+    if window > 1:
+        connection.send_message(Pipeline(user_id, window).serialize())
+        if 'ERROR' in connection.receive_message().decode():
+            logging.warning('server does not support pipelining')
+            window = 1
+    return window
+
+
+def _request_compression(connection, user_id, compression):
+    # returns the codec picked by the server, if any
+    if not compression:
+        return None
+    connection.send_message(
+        Compression(user_id, compression.split(',')).serialize())
+    codec = connection.receive_message().decode()
+    if 'ERROR' in codec:
+        logging.warning(f'snapshots will not be compressed: {codec}')
+        return None
+    return codec
+
+
+def _request_last_snapshot(connection, user_id):
+    # servers which can't tell which snapshots they hold have us resend all
+    connection.send_message(LastSnapshot(user_id).serialize())
+    try:
+        return int(connection.receive_message().decode())
+    except ValueError:
+        logging.warning('server does not report its last snapshot')
+        return 0
+
+
+def _log_skipped(skipped):
+    if skipped:
+        print(f'Skipped {skipped} snapshots already on the server')
+        logging.info(f'Skipped {skipped} snapshots already on the server')
+
+
+def _skip_known(host, port, user_id, snapshots, checkpoint=None):
+    # ask the server which snapshots it already holds, a batch at a time and
+    #  over a connection of our own, and only pass on the rest
+    connection, skipped, supported = None, 0, True
+    try:
+        while batch := list(itertools.islice(snapshots, DIGEST_BATCH)):
+            known = bytes(len(batch))
+            if supported:
+                digests = []
+                for i, packed_snapshot in batch:
+                    _, raw_snapshot = message_parts(packed_snapshot)
+                    digests.append((
+                        Snapshot(user_id, raw_snapshot).get_datetime(),
+                        hashlib.sha1(raw_snapshot).digest()))
+                message = Have(user_id, digests).serialize()
+                if connection is None:
+                    connection, answer = _connect(host, port, message)
+                else:
+                    connection.send_message(message)
+                    answer = connection.receive_message()
+                if answer.startswith(b'ERROR') or len(answer) != len(batch):
+                    logging.warning('server does not support deduplication')
+                    supported = False
+                else:
+                    known = answer
+
+            for (i, packed_snapshot), is_known in zip(batch, known):
+                if not is_known:
+                    yield i, packed_snapshot
+                    continue
+                skipped += 1
+                if checkpoint:
+                    checkpoint.acknowledge(i)
+        if connection:
+            connection.send_message(EndSession(user_id).serialize())
+    finally:
+        if connection:
+            connection.close()
+    _log_skipped(skipped)
+
+
+def _send_snapshots(connection, snapshots, window=1, checkpoint=None,
+                    codec=None, batch=1, chunk_size=CHUNK_SIZE):
+    # snapshots are (snapshot number, packed snapshot) pairs, of which up to
+    #  `window` may be waiting for their acks at any time; returns the number
+    #  of snapshots sent and their (uncompressed) size
+    in_flight = {}
+    total_snapshots, total_bytes = 0, 0
+    framed = isinstance(connection, FramedConnection)
+    pipelined = framed or window > 1
+    if framed and batch > 1:
+        snapshots = _batch_snapshots(snapshots, batch, chunk_size)
+    for sequence, (i, packed_snapshot) in enumerate(snapshots, 1):
+        if len(in_flight) == window:
+            _receive_ack(connection, in_flight, pipelined, checkpoint)
+        total_snapshots += len(i) if isinstance(i, list) else 1
+        total_bytes += message_size(packed_snapshot)
+        if not framed:
+            if codec:
+                packed_snapshot = compress(codec, packed_snapshot)
+            connection.send_message(packed_snapshot)
+        elif isinstance(i, list):
+            _send_frame(connection, packed_snapshot, sequence, codec,
+                        FLAGS.BATCH)
+        elif message_size(packed_snapshot) > chunk_size:
+            # the server spools the chunks to disk as they arrive, and acks
+            #  the snapshot once the last one's in
+            for chunk, more in Snapshot.serialize_chunks(packed_snapshot,
+                                                         chunk_size):
+                _send_frame(connection, chunk, sequence, codec,
+                            FLAGS.MORE if more else 0)
+        else:
+            _send_frame(connection, packed_snapshot, sequence, codec)
+        in_flight[sequence] = i
+    while in_flight:
+        _receive_ack(connection, in_flight, pipelined, checkpoint)
+    return total_snapshots, total_bytes
+
+
+def _send_frame(connection, message, sequence, codec=None, flags=0):
+    if codec:
+        message = compress(codec, message)
+        flags |= FLAGS.COMPRESSED
+    connection.send_message(message, sequence, flags)
+
+
+def _batch_snapshots(snapshots, batch, chunk_size=CHUNK_SIZE):
+    # groups (snapshot number, packed snapshot) pairs into (snapshot numbers,
+    #  packed batch) pairs, which are acked with a byte per snapshot; those
+    #  large enough to be sent in chunks are passed through as they are
+    items = []
+    for item in snapshots:
+        if message_size(item[1]) > chunk_size:
+            yield item
+            continue
+        items.append(item)
+        if len(items) == batch:
+            yield _pack_batch(items)
+            items = []
+    if items:
+        yield _pack_batch(items)
+
+
+def _pack_batch(items):
+    header, _ = message_parts(items[0][1])
+    user_id, = struct.unpack_from('<Q', header, 4)
+    return [i for i, _ in items], Snapshot.serialize_batch(
+        user_id, [message_parts(packed)[1] for _, packed in items])
+
+
+def _receive_ack(connection, in_flight, pipelined, checkpoint=None):
+    _log_snapshot_ack(connection.receive_message(), in_flight, pipelined,
+                      checkpoint)
+
+
+def _log_snapshot_ack(ack_msg, in_flight, pipelined, checkpoint=None):
+    # pipelined acks are preceded by the sequence number of their snapshot
+    if pipelined:
+        sequence, = struct.unpack('<I', ack_msg[:4])
+        ack_msg = ack_msg[4:]
+    else:
+        sequence = next(iter(in_flight))
+    i = in_flight.pop(sequence)
+    if isinstance(i, list):
+        # a batch's ack is either an error or a byte per snapshot
+        if ack_msg.startswith(b'ERROR'):
+            published = bytes(len(i))
+        else:
+            published, ack_msg = ack_msg, b'ERROR: snapshot was not published'
+        for i, is_published in zip(i, published):
+            if _log_ack(f'Snapshot #{i}', b'OK!' if is_published
+                        else ack_msg) and checkpoint:
+                checkpoint.acknowledge(i)
+        return
+    if _log_ack(f'Snapshot #{i}', ack_msg) and checkpoint:
+        checkpoint.acknowledge(i)
+
+
+def _upload_session(host, port, reader, snapshot_reader, window=1,
+                    workers=1, checkpoint=None, compression=None,
+                    dedup=False, protocol=PROTOCOL_VERSION, batch=1):
+    # send user data and all snapshots over a single connection, then tell
+    #  the server explicitly that the session is over
+    user_data = UserData(reader)
+    first_snapshot, last_datetime, start = 1, 0, reader.offset
+    stats = 0, 0
+
+    def read_snapshots():
+        first = first_snapshot
+        if checkpoint and checkpoint.datetime > last_datetime:
+            # the server doesn't hold the last snapshot the checkpoint says
+            #  was acknowledged (e.g. it's another server), so start over
+            logging.warning('checkpoint not confirmed by the server, '
+                            'uploading all snapshots')
+            checkpoint.reset()
+            reader.seek(start)
+            first = 1
+        for i, snapshot_data in enumerate(snapshot_reader, first):
+            snapshot = Snapshot(user_data.user_id, snapshot_data)
+            if checkpoint:
+                checkpoint.track(i, reader.offset, snapshot.get_datetime())
+            yield i, snapshot.serialize_parts()
+
+    # skip ahead past the last snapshot acknowledged in a previous upload,
+    #  without parsing what comes before it; snapshots are read lazily, once
+    #  the server has told which snapshots it holds
+    if checkpoint:
+        checkpoint.load()
+        if checkpoint.offset is not None:
+            reader.seek(checkpoint.offset)
+        first_snapshot = checkpoint.snapshot + 1
+    snapshots = read_snapshots()
+    if dedup:
+        snapshots = _skip_known(host, port, user_data.user_id, snapshots,
+                                checkpoint)
+
+    connection = _open_session(host, port, user_data.user_id, protocol)
+    with connection:
+        connection.send_message(user_data.serialize())
+        _log_ack('User data', connection.receive_message())
+
+        if checkpoint:
+            last_datetime = _request_last_snapshot(connection,
+                                                   user_data.user_id)
+        if workers == 1:
+            window = _request_pipelining(connection, user_data.user_id,
+                                         window)
+            codec = _request_compression(connection, user_data.user_id,
+                                         compression)
+            stats = _send_snapshots(connection, snapshots, window,
+                                    checkpoint, codec, batch)
+        connection.send_message(EndSession(user_data.user_id).serialize())
+
+    if workers > 1:
+        stats = _upload_parallel(host, port, user_data.user_id, snapshots,
+                                 window, workers, checkpoint, compression,
+                                 protocol, batch)
+    return stats
+
+
+def _upload_parallel(host, port, user_id, snapshots, window, workers,
+                     checkpoint=None, compression=None,
+                     protocol=PROTOCOL_VERSION, batch=1):
+    # this thread reads snapshots from the file, while each worker sends them
+    #  over a session of its own
+    snapshot_queue = queue.Queue(maxsize=workers * window * batch * 2)
+    total_snapshots, total_bytes = 0, 0
+    start_time = time.perf_counter()
+
+    def send():
+        connection = _open_session(host, port, user_id, protocol)
+        with connection:
+            worker_window = _request_pipelining(connection, user_id, window)
+            codec = _request_compression(connection, user_id, compression)
+            _send_snapshots(connection, iter(snapshot_queue.get, None),
+                            worker_window, checkpoint, codec, batch)
+            connection.send_message(EndSession(user_id).serialize())
+
+    def put(item):
+        # don't wait forever for workers which have all died
+        while True:
+            try:
+                snapshot_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                if all(future.done() for future in futures):
+                    return False
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(send) for _ in range(workers)]
+        for i, packed_snapshot in snapshots:
+            if not put((i, packed_snapshot)):
+                break
+            total_snapshots += 1
+            total_bytes += message_size(packed_snapshot)
+        for _ in futures:
+            put(None)
+    for future in futures:
+        future.result()     # re-raise the first error of any worker
+
+    summary = _summary(total_snapshots, total_bytes,
+                       time.perf_counter() - start_time)
+    print(f'Uploaded {summary}')
+    logging.info(f'Uploaded {summary}')
+    return total_snapshots, total_bytes
+
+
+def _summary(total_snapshots, total_bytes, elapsed):
+    megabytes = total_bytes / 2**20
+    return f'{total_snapshots} snapshots ({megabytes:.2f} MB) in ' \
+           f'{elapsed:.2f}s: {total_snapshots / elapsed:.1f} snapshots/s, ' \
+           f'{megabytes / elapsed:.2f} MB/s'
+
+
+def _read_snapshots(reader):
+    # forward snapshots as they are stored whenever the reader can provide
+    #  them in the wire format, rather than parsing and re-packing each one
+    if hasattr(reader, 'read_raw_snapshot'):
+        return reader.read_raw_snapshot()
+    return reader.read_snapshot()
+
+
+def _upload_sample(host, port, path, format=None, session=False, window=1,
+                   workers=1, resume=False, compression=None, dedup=False,
+                   read_ahead=0, protocol=PROTOCOL_VERSION, batch=1,
+                   encoding='protobuf'):
     if not host:
         host = '127.0.0.1'
     if not port:
         port = 5000
-    if not format:
-        format = DEFAULT_FORMAT
+    format = _sample_format(path, format)
 
     reader_module = __import__('bci.readers', globals(), locals(), [format])
-    reader = getattr(reader_module, format).reader_cls(path)
+    reader_cls = getattr(reader_module, format).reader_cls
+    # readers of uncompressed samples have nothing to read ahead, and ignore
+    #  the argument
+    reader = reader_cls(path, read_ahead=read_ahead)
     with reader:
 
         # generator for reading snapshots from data file
-        snapshot_reader = reader.read_snapshot()
+        snapshot_reader = _read_snapshots(reader)
+        if encoding == 'flat':
+            # snapshots are decoded once here, so that nothing downstream
+            #  has to decode them again
+            snapshot_reader = (FlatSnapshot(snapshot_data).serialize()
+                               for snapshot_data in snapshot_reader)
+        elif encoding != 'protobuf':
+            raise Exception(f'unsupported encoding "{encoding}"')
+
+        if resume:
+            checkpoint = Checkpoint(path)
+            try:
+                stats = _upload_session(host, port, reader, snapshot_reader,
+                                        window, workers, checkpoint,
+                                        compression, dedup, protocol, batch)
+            except BaseException:
+                checkpoint.close()
+                raise
+            checkpoint.complete()
+            return stats
+        if session or window > 1 or workers > 1 or compression or dedup \
+                or batch > 1:
+            return _upload_session(host, port, reader, snapshot_reader,
+                                   window, workers, compression=compression,
+                                   dedup=dedup, protocol=protocol, batch=batch)
 
         # send user data to server + receive ack message from server
-        connection = Connection.connect(host, port)
+        user_data = UserData(reader)
+        packed_user_data = user_data.serialize()
+        connection, ack_msg = _connect(host, port, packed_user_data)
         with connection:
-
-            user_data = UserData(reader)
-            packed_user_data = user_data.serialize()
-            connection.send_message(packed_user_data)
-
-            ack_msg = connection.receive_message()
-            if 'ERROR' in ack_msg.decode():
-                print(f'User data: {ack_msg.decode()}', file=sys.stderr)
-                logging.warning(f'{ack_msg.decode()}')
-            else:
-                print(f'User data: {ack_msg.decode()}')
-                logging.info(f'User data: {ack_msg.decode()}')
+            _log_ack('User data', ack_msg)
 
         # send snapshot to server + receive ack message from server
-        i = 1
-        while True:
-            connection = Connection.connect(host, port)
+        i, total_bytes = 1, 0
+        for snapshot_data in snapshot_reader:
+            snapshot = Snapshot(user_data.user_id, snapshot_data)
+            packed_snapshot = snapshot.serialize_parts()
+            connection, ack_msg = _connect(host, port, packed_snapshot)
             with connection:
-                try:
-                    snapshot = Snapshot(user_data.user_id,
-                                        next(snapshot_reader))
-                except StopIteration:
-                    break
-                packed_snapshot = snapshot.serialize()
-                connection.send_message(packed_snapshot)
+                total_bytes += message_size(packed_snapshot)
+                _log_ack(f'Snapshot #{i}', ack_msg)
+            i += 1
+        return i - 1, total_bytes
+
+
+def _upload_dir(host, port, path, pattern=SAMPLE_PATTERN, jobs=4, format=None,
+                **kwargs):
+    ''' Uploads every sample file in a directory, a few files at a time;
+        returns each file's (snapshots, bytes) uploaded, or the error which
+        stopped it '''
+    paths = sorted(str(sample) for sample in Path(path).glob(pattern)
+                   if sample.is_file() and
+                   not sample.name.endswith(SIDECAR_SUFFIXES))
+    if not paths:
+        raise Exception(f'no sample files matching "{pattern}" in {path}')
+    results = {}
+    start_time = time.perf_counter()
+
+    def upload(sample):
+        file_start_time = time.perf_counter()
+        try:
+            results[sample] = _upload_sample(host, port, sample, format,
+                                             **kwargs)
+        except Exception as error:
+            results[sample] = error
+            print(f'{sample}: ERROR: {error}', file=sys.stderr)
+            logging.warning(f'{sample}: {error}')
+            return
+        summary = _summary(*results[sample],
+                           time.perf_counter() - file_start_time)
+        print(f'{sample}: {summary}')
+        logging.info(f'{sample}: {summary}')
 
-                # receive ack message from server
-                ack_msg = connection.receive_message()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(upload, paths))
+
+    uploaded = [result for result in results.values()
+                if not isinstance(result, Exception)]
+    summary = _summary(sum(snapshots for snapshots, _ in uploaded),
+                       sum(size for _, size in uploaded),
+                       time.perf_counter() - start_time)
+    summary = f'Uploaded {summary} from {len(uploaded)}/{len(paths)} files'
+    print(summary)
+    logging.info(summary)
+    return {sample: results[sample] for sample in paths}
+
+
+async def _upload_sample_async(host, port, path, format=None, window=1,
+                               compression=None):
+    if not host:
+        host = '127.0.0.1'
+    if not port:
+        port = 5000
+    format = _sample_format(path, format)
+
+    reader_module = __import__('bci.readers', globals(), locals(), [format])
+    reader = getattr(reader_module, format).reader_cls(path)
+    with reader:
+        user_data = UserData(reader)
+        snapshot_reader = _read_snapshots(reader)
+        loop = asyncio.get_running_loop()
+
+        def read_snapshot():
+            # runs in the loop's executor, so reading and packing snapshots
+            #  doesn't hold back other uploads sharing the event loop
+            snapshot_data = next(snapshot_reader, None)
+            if snapshot_data is None:
+                return None
+            return Snapshot(user_data.user_id,
+                            snapshot_data).serialize_parts()
+
+        for attempt in itertools.count():
+            # the user data is small enough to be sent whole before a busy
+            #  server answers, so there's no reset to expect here (unlike in
+            #  _connect)
+            connection = await AsyncConnection.connect(host, port)
+            await connection.send_message(user_data.serialize())
+            answer = await connection.receive_message()
+            if not answer.startswith(b'BUSY'):
+                break
+            await connection.close()
+            await asyncio.sleep(_backoff(answer, attempt))
+        async with connection:
+            _log_ack('User data', answer)
+
+            if window > 1:
+                await connection.send_message(
+                    Pipeline(user_data.user_id, window).serialize())
+                ack_msg = await connection.receive_message()
                 if 'ERROR' in ack_msg.decode():
-                    print(f'Snapshot #{i}: {ack_msg.decode()}',
-                          file=sys.stderr)
-                    logging.warning(f'{ack_msg.decode()}')
-                else:
-                    print(f'Snapshot #{i}: {ack_msg.decode()}')
-                    logging.info(f'Snapshot #{i}: {ack_msg.decode()}')
-            i += 1
+                    logging.warning('server does not support pipelining')
+                    window = 1
+
+            codec = None
+            if compression:
+                await connection.send_message(Compression(
+                    user_data.user_id, compression.split(',')).serialize())
+                codec = (await connection.receive_message()).decode()
+                if 'ERROR' in codec:
+                    logging.warning(f'snapshots will not be compressed: '
+                                    f'{codec}')
+                    codec = None
+
+            in_flight = {}
+            sequence = 0
+            while True:
+                packed_snapshot = await loop.run_in_executor(None,
+                                                             read_snapshot)
+                if packed_snapshot is None:
+                    break
+                if len(in_flight) == window:
+                    await _receive_ack_async(connection, in_flight, window)
+                if codec:
+                    packed_snapshot = compress(codec, packed_snapshot)
+                await connection.send_message(packed_snapshot)
+                sequence += 1
+                in_flight[sequence] = sequence
+            while in_flight:
+                await _receive_ack_async(connection, in_flight, window)
+
+            await connection.send_message(
+                EndSession(user_data.user_id).serialize())
+
+
+async def _receive_ack_async(connection, in_flight, window):
+    _log_snapshot_ack(await connection.receive_message(), in_flight,
+                      window > 1)
 
 
 # API function aliases
 upload_sample = _upload_sample  # noqa
+upload_dir = _upload_dir  # noqa
+index_sample = _index_sample  # noqa
+convert_sample = _convert_sample  # noqa
+upload_sample_async = _upload_sample_async  # noqa
 
 if __name__ == '__main__':
     cli(prog_name='bci.client')
@@ -7,7 +7,7 @@ import pika
 import click
 from furl import furl
 
-from .utils import VERSION
+from .utils import VERSION, FlatSnapshot, is_flat
 from .utils.protobuf import cortex_pb2
 
 
@@ -26,12 +26,16 @@ class BasicParser:
         self.snapshot = None
 
     def parse(self, raw_snapshot_path):
-        # read from raw file and unpack using protobuf3
+        # read from raw file and unpack using protobuf3, unless the snapshot
+        #  is in the fixed-layout encoding, which needs no decoding
         datapath = Path(raw_snapshot_path)
-        self.snapshot = cortex_pb2.Snapshot()
-
         with open(datapath, 'rb') as f:
-            self.snapshot.ParseFromString(f.read())
+            raw_snapshot = f.read()
+        if is_flat(raw_snapshot):
+            self.snapshot = FlatSnapshot.deserialize(raw_snapshot)
+            return
+        self.snapshot = cortex_pb2.Snapshot()
+        self.snapshot.ParseFromString(raw_snapshot)
 
 
 # Final project
@@ -1,6 +1,7 @@
 import json
 import uuid
 
+import numpy as np
 from PIL import Image
 from pathlib import Path
 
@@ -17,16 +18,11 @@ class ColorImageParser(BasicParser):
         image_name = f'{uuid.uuid4().hex}.jpg'
         Path(datapath).mkdir(parents=True, exist_ok=True)
 
-        color_pixels = []
-        pixel = []
-        for byte in self.snapshot.color_image.data:
-            pixel.append(byte)
-            if len(pixel) == 3:
-                color_pixels.append(tuple(pixel))
-                pixel = []
-        image = Image.new('RGB', (self.snapshot.color_image.width,
-                                  self.snapshot.color_image.height))
-        image.putdata(color_pixels)
+        # view the pixels' bytes as an image, rather than copying each pixel
+        color_pixels = np.frombuffer(self.snapshot.color_image.data, np.uint8)
+        image = Image.fromarray(color_pixels.reshape(
+            self.snapshot.color_image.height, self.snapshot.color_image.width,
+            3))
         image.save(datapath / image_name)
 
         # return metadata
@@ -17,7 +17,7 @@ class DepthImageParser(BasicParser):
         datapath = DATA_DIR / 'depth_images'
         image_name = f'{uuid.uuid4().hex}.png'
         Path(datapath).mkdir(parents=True, exist_ok=True)
-        image = np.array(self.snapshot.depth_image.data).reshape(
+        image = np.asarray(self.snapshot.depth_image.data).reshape(
             self.snapshot.depth_image.height, self.snapshot.depth_image.width
         )
         plt.imshow(image, cmap='hot', interpolation='nearest')
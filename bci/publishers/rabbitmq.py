@@ -1,28 +1,247 @@
+import os
 import json
+import time
+import queue
 import logging
+import threading
+from contextlib import contextmanager
 from datetime import datetime
+from types import SimpleNamespace
 
 import pika
 from pathlib import Path
 
-from ..utils import DATA_DIR, MSG_TYPES
+from ..utils import DATA_DIR, MSG_TYPES, snapshot_dir
 from ..utils.protobuf import cortex_pb2
 
+# with publisher_commit set, messages are published in transactions of at
+#  most COMMIT_BATCH messages (publisher_batch), gathered for COMMIT_LINGER
+#  milliseconds at most (publisher_linger)
+COMMIT_BATCH = 64
+COMMIT_LINGER = 5
+
+# idle publishers, and bursting ones, by the address of the message queue
+#  they publish to
+_pools = {}
+_committers = {}
+_pools_lock = threading.Lock()
+
 
 def publish(message, **kwargs):
+    publish_batch([message], **kwargs)
+
+
+def publish_batch(messages, **kwargs):
+    ''' Publishes several messages of the same type over a single connection
+        (and channel) to the message queue '''
+    if _flag(kwargs.get('publisher_commit', False)):
+        _committer(**kwargs).publish(messages, **kwargs)
+        return
+    with _publisher(**kwargs) as publisher:
+        publisher.publish(messages, **kwargs)
+
+
+class Publisher:
+    ''' Keeps a connection (and channel) to the message queue open between
+        messages, declaring the exchanges once per connection; pika
+        connections aren't thread safe, so a publisher is only lent to one
+        thread at a time (see _publisher) '''
+    transactional = False
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.connection = None
+        self.channel = None
+
+    def publish(self, messages, **kwargs):
+        # a connection lost midway is reopened once, carrying on from what
+        #  failed to be published (a snapshot is published twice over, see
+        #  _prepare); messages are prepared only once
+        prepared = [prepared for message in messages
+                    for prepared in _prepare(message, **kwargs)]
+        sent = 0
+        for attempt in range(2):
+            self.open()
+            try:
+                for item in prepared[sent:]:
+                    _send(self.channel, *item)
+                    sent += 1
+                return
+            except pika.exceptions.AMQPError as error:
+                self.close()
+                if attempt:
+                    raise Exception(f'could not publish to rabbitmq: '
+                                    f'{error!r}')
+                logging.warning(f'lost connection to rabbitmq, reconnecting: '
+                                f'{error!r}')
+
+    def open(self):
+        if self.connection is not None:
+            # notice whether the connection was dropped (e.g. by the broker,
+            #  for missing heartbeats) while idle, before publishing over it
+            try:
+                self.connection.process_data_events()
+            except pika.exceptions.AMQPError:
+                self.close()
+        if self.connection is None:
+            self.connection = _connect(self.host, self.port)
+            self.channel = self.connection.channel()
+            _declare(self.channel)
+            if self.transactional:
+                self.channel.tx_select()
+
+    def close(self):
+        try:
+            if self.connection.is_open:
+                self.connection.close()
+        except pika.exceptions.AMQPError:
+            pass
+        self.connection = self.channel = None
+
+
+class CommittingPublisher(Publisher):
+    ''' Publishes the messages of all threads in bursts, from a thread of its
+        own, each burst in a transaction; publishing returns only once the
+        broker has committed the burst, so it's acked to the client only once
+        it's safe with the broker '''
+    transactional = True
+
+    def __init__(self, host, port, batch=COMMIT_BATCH, linger=COMMIT_LINGER):
+        super().__init__(host, port)
+        self.batch = batch
+        self.linger = linger / 1000
+        self.pending = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def publish(self, messages, **kwargs):
+        # messages are prepared (and snapshots saved) by the calling thread,
+        #  leaving only their publishing to the burst
+        request = SimpleNamespace(
+            count=len(messages), done=threading.Event(), error=None,
+            prepared=[prepared for message in messages
+                      for prepared in _prepare(message, **kwargs)])
+        self.pending.put(request)
+        request.done.wait()
+        if request.error:
+            raise request.error
+
+    def run(self):
+        while True:
+            burst = [self.pending.get()]
+            count = burst[0].count
+            deadline = time.monotonic() + self.linger
+            while count < self.batch:
+                try:
+                    request = self.pending.get(
+                        timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                burst.append(request)
+                count += request.count
+            try:
+                self.commit([prepared for request in burst
+                             for prepared in request.prepared])
+            except Exception as error:
+                for request in burst:
+                    request.error = error
+            for request in burst:
+                request.done.set()
+
+    def commit(self, prepared):
+        # nothing in a transaction is delivered before it's committed, so a
+        #  burst whose connection was lost is published again in whole
+        for attempt in range(2):
+            self.open()
+            try:
+                for item in prepared:
+                    _send(self.channel, *item)
+                self.channel.tx_commit()
+                return
+            except pika.exceptions.AMQPError as error:
+                self.close()
+                if attempt:
+                    raise Exception(f'could not publish to rabbitmq: '
+                                    f'{error!r}')
+                logging.warning(f'lost connection to rabbitmq, reconnecting: '
+                                f'{error!r}')
+
+
+def _address(**kwargs):
     if (not kwargs['publisher_host']) or (not kwargs['publisher_port']):
         raise ConnectionError('no host or port provided for publisher service')
+    return kwargs['publisher_host'], kwargs['publisher_port']
 
-    # first check and establish connection
+
+def _committer(**kwargs):
+    address = _address(**kwargs)
+    with _pools_lock:
+        if address not in _committers:
+            _committers[address] = CommittingPublisher(
+                *address,
+                batch=int(kwargs.get('publisher_batch', COMMIT_BATCH)),
+                linger=float(kwargs.get('publisher_linger', COMMIT_LINGER)))
+        return _committers[address]
+
+
+def _flag(value):
+    # URL arguments are strings, e.g. ?commit=1 or ?commit=false
+    value = str(value).lower()
+    if value not in ('1', 'true', 'yes', 'on', '0', 'false', 'no', 'off'):
+        raise ValueError(f'not a boolean: "{value}"')
+    return value in ('1', 'true', 'yes', 'on')
+
+
+@contextmanager
+def _publisher(**kwargs):
+    # lends out an idle publisher, or a new one if all are in use, so there
+    #  are only ever as many connections as messages published at a time
+    address = _address(**kwargs)
+    with _pools_lock:
+        pool = _pools.setdefault(address, [])
+        publisher = pool.pop() if pool else Publisher(*address)
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters(
-            kwargs['publisher_host'], kwargs['publisher_port']))
+        yield publisher
+    finally:
+        with _pools_lock:
+            _pools.setdefault(address, []).append(publisher)
+
+
+def _forget_publishers():
+    # forked processes (see run-server --processes) open connections of
+    #  their own rather than sharing their parent's
+    global _pools_lock
+    _pools.clear()
+    _committers.clear()
+    _pools_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_publishers)
+
+
+def _connect(host, port):
+    try:
+        return pika.BlockingConnection(pika.ConnectionParameters(host, port))
     except pika.exceptions.AMQPConnectionError:
         error_msg = f"could not connect to rabbitmq through host " \
-                    f"{kwargs['publisher_host']} and port " \
-                    f"{kwargs['publisher_port']}"
+                    f"{host} and port {port}"
         raise ConnectionError(error_msg)
 
+
+def _declare(channel):
+    channel.exchange_declare(exchange='parse_results', exchange_type='topic')
+    channel.exchange_declare(exchange='raw_snapshot', exchange_type='fanout')
+
+
+def _send(channel, exchange, routing_key, body, destination):
+    channel.basic_publish(exchange=exchange, routing_key=routing_key,
+                          body=body)
+    logging.info(f'Sent to {destination}: {body}')
+
+
+def _prepare(message, **kwargs):
+    # returns what to publish about a message, as (exchange, routing key,
+    #  body, destination) tuples; snapshots are saved on the way
     if kwargs['msg_type'] == MSG_TYPES.USER_DATA:
         # gender issues :)
         user_format = cortex_pb2.User()
@@ -46,72 +265,18 @@ def publish(message, **kwargs):
         }
         user_data = json.dumps(user_data)
 
-        channel = connection.channel()
-        channel.exchange_declare(exchange='parse_results',
-                                 exchange_type='topic')
-        channel.basic_publish(exchange='parse_results',
-                              routing_key='users', body=user_data)
-        logging.info(f'Sent to users topic: {user_data}')
-        connection.close()
+        return [('parse_results', 'users', user_data, 'users topic')]
 
     elif kwargs['msg_type'] == MSG_TYPES.SNAPSHOT:
-
-        # save snapshot raw data to file system, using protobuf3
-        timestamp = datetime.fromtimestamp(message.datetime/1000)
-        timestamp = timestamp.strftime("%Y-%m-%d_%H-%M-%S-%f")[:-3]
-
-        datapath = DATA_DIR / str(kwargs['user_id']) / timestamp
-
-        packed = cortex_pb2.Snapshot()
-        packed.datetime = message.datetime
-        pose = packed.pose
-        translation = pose.translation
-        translation.x = message.pose.translation.x
-        translation.y = message.pose.translation.y
-        translation.z = message.pose.translation.z
-        rotation = pose.rotation
-        rotation.x = message.pose.rotation.x
-        rotation.y = message.pose.rotation.y
-        rotation.z = message.pose.rotation.z
-        rotation.w = message.pose.rotation.w
-
-        color_image = packed.color_image
-        color_image.width = message.color_image.width
-        color_image.height = message.color_image.height
-        color_image.data += message.color_image.data
-
-        depth_image = packed.depth_image
-        depth_image.width = message.depth_image.width
-        depth_image.height = message.depth_image.height
-        depth_image.data.extend(message.depth_image.data)
-
-        feelings = packed.feelings
-        feelings.hunger = message.feelings.hunger
-        feelings.thirst = message.feelings.thirst
-        feelings.exhaustion = message.feelings.exhaustion
-        feelings.happiness = message.feelings.happiness
-
-        packed = packed.SerializeToString()
-
-        Path(datapath).mkdir(parents=True, exist_ok=True)
-        with open(datapath / 'snapshot.raw', 'wb') as f:
-            f.write(packed)
+        raw_path = _save_snapshot(message, **kwargs)
 
         # publish the address of the raw snapshot to a fanout exchange
         data = {
             'user_id': kwargs['user_id'],
-            'address': str(datapath / 'snapshot.raw')
+            'address': str(raw_path)
         }
         data = json.dumps(data)
 
-        channel = connection.channel()
-        channel.exchange_declare(exchange='raw_snapshot',
-                                 exchange_type='fanout')
-        channel.basic_publish(exchange='raw_snapshot', routing_key='',
-                              body=data)
-        logging.info(f'Sent to fanout: {data}')
-        connection.close()
-
         # serialize snapshot metadata
         timestamp = datetime.fromtimestamp(message.datetime/1000)
         timestamp = timestamp.strftime("%B %-d, %Y at %H:%M:%S.%f")[:-3]
@@ -122,13 +287,58 @@ def publish(message, **kwargs):
         }
         metadata = json.dumps(metadata)
 
-        # publish the metadata of the snapshot to a topic exchange
-        connection = pika.BlockingConnection(pika.ConnectionParameters(
-            kwargs['publisher_host'], kwargs['publisher_port']))
-        channel = connection.channel()
-        channel.exchange_declare(exchange='parse_results',
-                                 exchange_type='topic')
-        channel.basic_publish(exchange='parse_results',
-                              routing_key='snapshots', body=metadata)
-        logging.info(f'Sent to snapshots topic: {metadata}')
-        connection.close()
+        # and publish the metadata of the snapshot to a topic exchange
+        return [('raw_snapshot', '', data, 'fanout'),
+                ('parse_results', 'snapshots', metadata, 'snapshots topic')]
+    return []
+
+
+def _save_snapshot(message, **kwargs):
+    # snapshots the server spooled to disk as they arrived are saved already;
+    #  others are saved as the client sent them, if they were received as
+    #  they are, and serialized again otherwise
+    if getattr(message, 'path', None):
+        return message.path
+    datapath = snapshot_dir(kwargs['user_id'], message.datetime,
+                            Path(kwargs.get('datapath', DATA_DIR)))
+    packed = getattr(message, 'raw_data', None)
+    if packed is None:
+        packed = _serialize_snapshot(message)
+
+    Path(datapath).mkdir(parents=True, exist_ok=True)
+    with open(datapath / 'snapshot.raw', 'wb') as f:
+        f.write(packed)
+    return datapath / 'snapshot.raw'
+
+
+def _serialize_snapshot(message):
+    packed = cortex_pb2.Snapshot()
+    packed.datetime = message.datetime
+    pose = packed.pose
+    translation = pose.translation
+    translation.x = message.pose.translation.x
+    translation.y = message.pose.translation.y
+    translation.z = message.pose.translation.z
+    rotation = pose.rotation
+    rotation.x = message.pose.rotation.x
+    rotation.y = message.pose.rotation.y
+    rotation.z = message.pose.rotation.z
+    rotation.w = message.pose.rotation.w
+
+    color_image = packed.color_image
+    color_image.width = message.color_image.width
+    color_image.height = message.color_image.height
+    color_image.data += message.color_image.data
+
+    depth_image = packed.depth_image
+    depth_image.width = message.depth_image.width
+    depth_image.height = message.depth_image.height
+    depth_image.data.extend(message.depth_image.data)
+
+    feelings = packed.feelings
+    feelings.hunger = message.feelings.hunger
+    feelings.thirst = message.feelings.thirst
+    feelings.exhaustion = message.feelings.exhaustion
+    feelings.happiness = message.feelings.happiness
+
+    return packed.SerializeToString()
@@ -0,0 +1,82 @@
+import struct
+
+import numpy as np
+
+from ..utils.protobuf import cortex_pb2
+
+# timestamp, translation (x, y, z), rotation (x, y, z, w), color image size
+SNAPSHOT_HEADER = struct.Struct('<Q3d4d2I')
+DEPTH_HEADER = struct.Struct('<2I')
+FEELINGS = struct.Struct('<4f')
+GENDERS = {b'm': 'male', b'f': 'female', b'o': 'other'}
+
+
+class BinaryReader:
+    ''' Reads the legacy (uncompressed) binary sample format, yielding the same
+        Protobuf snapshots as the Protobuf reader does '''
+    def __init__(self, filename, read_ahead=0):
+        # samples aren't compressed, so there's nothing to read ahead; the
+        #  argument is taken all the same, as by the other readers
+        self.filename = filename
+
+    def __enter__(self):
+        self.fp = open(self.filename, 'rb')
+        # parse header
+        self.user_id, username_length = struct.unpack('QI', self.fp.read(12))
+        self.username = self.fp.read(username_length).decode()
+        self.birthdate, gender = struct.unpack('Ic', self.fp.read(5))
+        self.gender = GENDERS.get(gender.lower(), 'other')
+        self.offset = self.fp.tell()
+
+    def read_snapshot(self):
+        while True:
+            try:
+                timestamp, *pose, color_height, color_width = \
+                    SNAPSHOT_HEADER.unpack(self.fp.read(SNAPSHOT_HEADER.size))
+            except struct.error:
+                break
+            snapshot = cortex_pb2.Snapshot()
+            snapshot.datetime = timestamp
+            translation, rotation = snapshot.pose.translation, \
+                snapshot.pose.rotation
+            translation.x, translation.y, translation.z, \
+                rotation.x, rotation.y, rotation.z, rotation.w = pose
+
+            # color pixels are stored as BGR; reverse each one's byte order
+            #  in a single pass over the whole image
+            color = self._read_exactly(color_height * color_width * 3)
+            color = np.frombuffer(color, np.uint8).reshape(-1, 3)[:, ::-1]
+            snapshot.color_image.height = color_height
+            snapshot.color_image.width = color_width
+            snapshot.color_image.data = color.tobytes()
+
+            depth_height, depth_width = \
+                DEPTH_HEADER.unpack(self._read_exactly(DEPTH_HEADER.size))
+            depth = self._read_exactly(depth_height * depth_width * 4)
+            snapshot.depth_image.height = depth_height
+            snapshot.depth_image.width = depth_width
+            snapshot.depth_image.data.extend(
+                np.frombuffer(depth, '<f4').tolist())
+
+            feelings = snapshot.feelings
+            feelings.hunger, feelings.thirst, feelings.exhaustion, \
+                feelings.happiness = \
+                FEELINGS.unpack(self._read_exactly(FEELINGS.size))
+            self.offset = self.fp.tell()
+            yield snapshot
+
+    def _read_exactly(self, size):
+        data = self.fp.read(size)
+        if len(data) != size:
+            raise Exception('snapshot data is incomplete')
+        return data
+
+    def seek(self, offset):
+        self.fp.seek(offset)
+        self.offset = offset
+
+    def __exit__(self, exception, error, traceback):
+        self.fp.close()
+
+
+reader_cls = BinaryReader
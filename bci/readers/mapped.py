@@ -0,0 +1,89 @@
+import mmap
+import os
+import struct
+
+from ..utils.protobuf import cortex_pb2
+from .protobuf import ProtobufReader, load_index
+
+
+class MappedProtobufReader(ProtobufReader):
+    ''' Reads uncompressed Protobuf sample files through a memory map, handing
+        out snapshots as memoryview slices of the file rather than copies '''
+    def __init__(self, filename, read_ahead=0):
+        # snapshots are slices of the map, so there's nothing to read ahead
+        super().__init__(filename, read_ahead=0)
+
+    def __enter__(self):
+        self.fp = open(self.filename, 'rb')
+        self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = memoryview(self.map)
+        # parse header
+        msg_size, = struct.unpack_from('I', self.data)
+        user = cortex_pb2.User()
+        user.ParseFromString(self.data[4:4 + msg_size])
+        self.user_id, self.username, self.birthdate = \
+            user.user_id, user.username, user.birthday
+        if user.gender == user.MALE:
+            self.gender = 'male'
+        elif user.gender == user.FEMALE:
+            self.gender = 'female'
+        elif user.gender == user.OTHER:
+            self.gender = 'other'
+        self.offset = self.start = 4 + msg_size
+        self.index = load_index(self.filename)
+
+    def _read_snapshots(self, offset=None):
+        # yields raw snapshots along with the offset of the data following them
+        offset = self.offset if offset is None else offset
+        while offset + 4 <= len(self.data):
+            msg_size, = struct.unpack_from('I', self.data, offset)
+            offset += 4
+            if offset + msg_size > len(self.data):
+                raise Exception('snapshot data is incomplete')
+            yield self.data[offset:offset + msg_size], offset + msg_size
+            offset += msg_size
+
+    def seek(self, offset):
+        self.offset = offset
+
+    def snapshot_index(self):
+        # walking the length prefixes is cheap enough to do on first use
+        if self.index is None:
+            self.index = [(offset - len(snapshot), len(snapshot)) for
+                          snapshot, offset in self._read_snapshots(self.start)]
+        return self.index
+
+    def _read_at(self, offset, size):
+        self.offset = offset + size
+        return self.data[offset:offset + size]
+
+    def __exit__(self, exception, error, traceback):
+        self.stopped.set()
+        self.data.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # snapshots handed out are still in use; the map is closed once
+            #  they're garbage collected
+            pass
+        self.fp.close()
+
+
+def is_sample(filename):
+    ''' Whether a file starts with a plausible, uncompressed user message '''
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        header = f.read(4)
+        if len(header) < 4:
+            return False
+        msg_size, = struct.unpack('I', header)
+        if msg_size > size - 4:
+            return False
+        try:
+            cortex_pb2.User().ParseFromString(f.read(msg_size))
+        except Exception:
+            return False
+    return True
+
+
+reader_cls = MappedProtobufReader
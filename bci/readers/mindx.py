@@ -0,0 +1,194 @@
+import bisect
+import mmap
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from ..utils.compression import CODECS
+from ..utils.protobuf import cortex_pb2
+from ..utils.protocol import Snapshot, UserData
+
+# layout: header, user message, independently compressed snapshot blocks,
+#  index of the blocks, and a trailer pointing at the index
+MAGIC = b'MINDX1'
+HEADER = struct.Struct('<6sB')          # magic, codec name length
+USER = struct.Struct('<I')              # user message size
+INDEX_ENTRY = struct.Struct('<QQII')    # datetime, offset, size, crc32
+TRAILER = struct.Struct('<QI6s')        # index offset, snapshots, magic
+
+
+class MindxReader:
+    def __init__(self, filename, read_ahead=0, workers=None):
+        self.filename = filename
+        # number of blocks to decompress in parallel, and to keep ready ahead
+        #  of the one being consumed
+        self.workers = workers or os.cpu_count()
+        self.read_ahead = read_ahead or 2 * self.workers
+
+    def __enter__(self):
+        self.fp = open(self.filename, 'rb')
+        self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, codec_length = HEADER.unpack_from(self.map)
+        index_offset, count, trailer_magic = \
+            TRAILER.unpack_from(self.map, len(self.map) - TRAILER.size)
+        if magic != MAGIC or trailer_magic != MAGIC:
+            raise Exception('Not a mindx file')
+        self.codec = self.map[HEADER.size:HEADER.size + codec_length].decode()
+        if self.codec not in CODECS:
+            raise Exception(f'unsupported codec "{self.codec}"')
+        _, self.decompress = CODECS[self.codec]
+
+        # parse header
+        offset = HEADER.size + codec_length
+        msg_size, = USER.unpack_from(self.map, offset)
+        user = cortex_pb2.User()
+        offset += USER.size
+        user.ParseFromString(self.map[offset:offset + msg_size])
+        self.user_id, self.username, self.birthdate = \
+            user.user_id, user.username, user.birthday
+        if user.gender == user.MALE:
+            self.gender = 'male'
+        elif user.gender == user.FEMALE:
+            self.gender = 'female'
+        elif user.gender == user.OTHER:
+            self.gender = 'other'
+        self.index = list(INDEX_ENTRY.iter_unpack(
+            self.map[index_offset:index_offset + count * INDEX_ENTRY.size]))
+        self.offsets = [offset for _, offset, _, _ in self.index]
+        self.offset = offset + msg_size
+
+    def datetimes(self):
+        return [datetime for datetime, _, _, _ in self.index]
+
+    def read_raw_snapshot(self):
+        # continue from the block self.offset points at
+        start = bisect.bisect_left(self.offsets, self.offset)
+        for entry, raw_snapshot in self._decompress(self.index[start:]):
+            _, offset, size, _ = entry
+            self.offset = offset + size
+            yield raw_snapshot
+
+    def read_snapshot(self):
+        for raw_snapshot in self.read_raw_snapshot():
+            snapshot = cortex_pb2.Snapshot()
+            snapshot.ParseFromString(raw_snapshot)
+            yield snapshot
+
+    def seek(self, offset):
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        snapshot = cortex_pb2.Snapshot()
+        snapshot.ParseFromString(self._decompress_block(self.index[i]))
+        return snapshot
+
+    def read_snapshots(self, start=0, stop=None):
+        for _, raw_snapshot in self._decompress(self.index[start:stop]):
+            snapshot = cortex_pb2.Snapshot()
+            snapshot.ParseFromString(raw_snapshot)
+            yield snapshot
+
+    def _decompress(self, entries):
+        # blocks are compressed independently, so several of them are
+        #  decompressed at once (zlib releases the GIL while doing so)
+        if self.workers == 1:
+            for entry in entries:
+                yield entry, self._decompress_block(entry)
+            return
+        with ThreadPoolExecutor(self.workers) as executor:
+            pending = deque()
+            for entry in entries:
+                pending.append(
+                    (entry, executor.submit(self._decompress_block, entry)))
+                if len(pending) > self.read_ahead:
+                    entry, block = pending.popleft()
+                    yield entry, block.result()
+            while pending:
+                entry, block = pending.popleft()
+                yield entry, block.result()
+
+    def _decompress_block(self, entry):
+        _, offset, size, crc = entry
+        raw_snapshot = self.decompress(self.map[offset:offset + size])
+        if zlib.crc32(raw_snapshot) != crc:
+            raise Exception(f'snapshot at offset {offset} is corrupt')
+        return raw_snapshot
+
+    def __exit__(self, exception, error, traceback):
+        self.map.close()
+        self.fp.close()
+
+
+class MindxWriter:
+    def __init__(self, filename, codec='zlib'):
+        if codec not in CODECS:
+            raise Exception(f'unsupported codec "{codec}"')
+        self.filename = filename
+        self.codec = codec
+        self.compress, _ = CODECS[codec]
+        self.index = []
+
+    def __enter__(self):
+        self.fp = open(self.filename, 'wb')
+        return self
+
+    def write_user(self, raw_user):
+        self.fp.write(HEADER.pack(MAGIC, len(self.codec)))
+        self.fp.write(self.codec.encode())
+        self.fp.write(USER.pack(len(raw_user)))
+        self.fp.write(raw_user)
+
+    def write_snapshot(self, raw_snapshot, datetime, block=None):
+        # block may be given if the snapshot's already been compressed
+        if block is None:
+            block = self.compress(raw_snapshot)
+        self.index.append((datetime, self.fp.tell(), len(block),
+                           zlib.crc32(raw_snapshot)))
+        self.fp.write(block)
+
+    def __exit__(self, exception, error, traceback):
+        if exception is None:
+            index_offset = self.fp.tell()
+            for entry in self.index:
+                self.fp.write(INDEX_ENTRY.pack(*entry))
+            self.fp.write(TRAILER.pack(index_offset, len(self.index), MAGIC))
+        self.fp.close()
+
+
+def convert(reader, filename, codec='zlib', workers=None):
+    ''' Writes the user and snapshots read by a reader (already entered) into a
+        .mindx file, compressing blocks in parallel; returns the number of
+        snapshots written '''
+    if hasattr(reader, 'read_raw_snapshot'):
+        raw_snapshots = reader.read_raw_snapshot()
+    else:
+        raw_snapshots = (snapshot.SerializeToString()
+                         for snapshot in reader.read_snapshot())
+    workers = workers or os.cpu_count()
+    writer = MindxWriter(filename, codec)
+    with writer, ThreadPoolExecutor(workers) as executor:
+        writer.write_user(UserData(reader).serialize()[12:])
+        pending = deque()
+
+        def write_next():
+            raw_snapshot, block = pending.popleft()
+            datetime = Snapshot(reader.user_id, raw_snapshot).get_datetime()
+            writer.write_snapshot(raw_snapshot, datetime, block.result())
+
+        for raw_snapshot in raw_snapshots:
+            raw_snapshot = bytes(raw_snapshot)
+            pending.append(
+                (raw_snapshot, executor.submit(writer.compress, raw_snapshot)))
+            if len(pending) > 2 * workers:
+                write_next()
+        while pending:
+            write_next()
+    return len(writer.index)
+
+
+reader_cls = MindxReader
@@ -1,15 +1,37 @@
+import io
+import os
 import gzip
+import queue
 import struct
+import logging
+import threading
+from pathlib import Path
 
 from ..utils.protobuf import cortex_pb2
 
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+INDEX_MAGIC = b'BCIDX1'
+INDEX_HEADER = struct.Struct('<6sQQI')   # magic, file size, mtime, snapshots
+INDEX_ENTRY = struct.Struct('<QI')       # snapshot offset and size
+SEEK_POINT_SPACING = 4 * 2**20
+BUFFER_SIZE = 2**20
+GZIP_MAGIC = b'\x1f\x8b'
+
 
 class ProtobufReader:
-    def __init__(self, filename):
+    def __init__(self, filename, read_ahead=0):
         self.filename = filename
+        self.index = None
+        # number of snapshots to decompress in the background, if any
+        self.read_ahead = read_ahead
+        self.stopped = threading.Event()
 
     def __enter__(self):
-        self.fp = gzip.open(self.filename, 'rb')
+        self.fp = self._open()
         # parse header
         msg_size, = struct.unpack('I', self.fp.read(4))
         user = cortex_pb2.User()
@@ -22,20 +44,194 @@ class ProtobufReader:
             self.gender = 'female'
         elif user.gender == user.OTHER:
             self.gender = 'other'
+        self.offset = self.fp.tell()
+        self.index = load_index(self.filename)
+
+    def _open(self):
+        # with the zran seek points saved by build_index(), seeking anywhere
+        #  only decompresses from the nearest seek point onwards
+        seek_points = Path(f'{self.filename}.gzidx')
+        if indexed_gzip and self.index_is_fresh(seek_points):
+            return indexed_gzip.IndexedGzipFile(self.filename,
+                                                index_file=str(seek_points))
+        # buffer generously, as snapshots are read a few bytes at a time
+        return io.BufferedReader(gzip.open(self.filename, 'rb'),
+                                 buffer_size=BUFFER_SIZE)
+
+    def index_is_fresh(self, index_path):
+        return index_path.exists() and \
+            index_path.stat().st_mtime_ns >= os.stat(self.filename).st_mtime_ns
 
     def read_snapshot(self):
+        for snapshot, offset in self._read_ahead(self._parse_snapshots()):
+            self.offset = offset
+            yield snapshot
+
+    def read_raw_snapshot(self):
+        # snapshots are stored in the same format the client sends them in, so
+        #  they may be forwarded as they are, without parsing them
+        for raw_snapshot, offset in self._read_ahead(self._read_snapshots()):
+            self.offset = offset
+            yield raw_snapshot
+
+    def _read_snapshots(self):
+        # yields raw snapshots along with the offset of the data following them
         while True:
             try:
                 msg_size, = struct.unpack('I', self.fp.read(4))
-                snapshot = cortex_pb2.Snapshot()
-                snapshot.ParseFromString(self.fp.read(msg_size))
-                yield snapshot
+                raw_snapshot = self.fp.read(msg_size)
+                if len(raw_snapshot) != msg_size:
+                    raise Exception('snapshot data is incomplete')
+                yield raw_snapshot, self.fp.tell()
 
             except struct.error:
                 break
 
+    def _parse_snapshots(self):
+        for raw_snapshot, offset in self._read_snapshots():
+            snapshot = cortex_pb2.Snapshot()
+            snapshot.ParseFromString(raw_snapshot)
+            yield snapshot, offset
+
+    def _read_ahead(self, snapshots):
+        # have a producer thread decompress snapshots into a bounded queue,
+        #  so reading overlaps with whatever the consumer does with them
+        if not self.read_ahead:
+            yield from snapshots
+            return
+        ready = queue.Queue(maxsize=self.read_ahead)
+
+        def put(item):
+            while not self.stopped.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def produce():
+            try:
+                for item in snapshots:
+                    put(item)
+                put(None)
+            except Exception as error:
+                put(error)
+
+        threading.Thread(target=produce, daemon=True).start()
+        while (item := ready.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def seek(self, offset):
+        # skip to a snapshot boundary previously reported by self.offset,
+        #  decompressing but not parsing the snapshots in between
+        self.fp.seek(offset)
+        self.offset = offset
+
+    def snapshot_index(self):
+        # (offset, size) of every snapshot; scanned on first use, unless
+        #  build_index() saved it beforehand
+        if self.index is None:
+            self.index = scan_snapshots(self.filename)
+        return self.index
+
+    def __len__(self):
+        return len(self.snapshot_index())
+
+    def __getitem__(self, i):
+        snapshot = cortex_pb2.Snapshot()
+        snapshot.ParseFromString(self._read_at(*self.snapshot_index()[i]))
+        return snapshot
+
+    def read_snapshots(self, start=0, stop=None):
+        # note that this moves the position read_snapshot() continues from
+        for offset, size in self.snapshot_index()[start:stop]:
+            snapshot = cortex_pb2.Snapshot()
+            snapshot.ParseFromString(self._read_at(offset, size))
+            yield snapshot
+
+    def _read_at(self, offset, size):
+        self.seek(offset)
+        data = self.fp.read(size)
+        self.offset = self.fp.tell()
+        return data
+
     def __exit__(self, exception, error, traceback):
+        self.stopped.set()
         self.fp.close()
 
 
-reader_cls = ProtobufReader
+def scan_snapshots(filename, fp=None):
+    ''' Returns the (offset, size) of each snapshot in a sample file, without
+        parsing them '''
+    with fp or gzip.open(filename, 'rb') as fp:
+        msg_size, = struct.unpack('I', fp.read(4))
+        fp.seek(msg_size, os.SEEK_CUR)      # skip user data
+        snapshots = []
+        while len(header := fp.read(4)) == 4:
+            msg_size, = struct.unpack('I', header)
+            snapshots.append((fp.tell(), msg_size))
+            fp.seek(msg_size, os.SEEK_CUR)
+    return snapshots
+
+
+def build_index(filename):
+    ''' Saves the snapshots' offsets in a <filename>.idx sidecar file, and if
+        indexed_gzip is installed, gzip seek points in <filename>.gzidx '''
+    fp = None
+    if not is_gzipped(filename):
+        fp = open(filename, 'rb')
+    elif indexed_gzip:
+        fp = indexed_gzip.IndexedGzipFile(filename,
+                                          spacing=SEEK_POINT_SPACING)
+        fp.build_full_index()
+        fp.export_index(f'{filename}.gzidx')
+    else:
+        logging.warning('indexed_gzip is not installed, saving no gzip seek '
+                        'points; seeking will decompress the whole sample')
+    snapshots = scan_snapshots(filename, fp)
+
+    stat = os.stat(filename)
+    with open(f'{filename}.idx', 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size,
+                                  stat.st_mtime_ns, len(snapshots)))
+        for offset, size in snapshots:
+            f.write(INDEX_ENTRY.pack(offset, size))
+    return snapshots
+
+
+def load_index(filename):
+    ''' Returns the snapshots' offsets saved by build_index(), or None if
+        there's no index or the sample file changed since it was built '''
+    index_path = Path(f'{filename}.idx')
+    if not index_path.exists():
+        return None
+    data = index_path.read_bytes()
+    if len(data) < INDEX_HEADER.size:
+        return None
+    magic, size, mtime, count = INDEX_HEADER.unpack_from(data)
+    stat = os.stat(filename)
+    if magic != INDEX_MAGIC or (size, mtime) != (stat.st_size,
+                                                 stat.st_mtime_ns):
+        return None
+    return list(INDEX_ENTRY.iter_unpack(data[INDEX_HEADER.size:]))[:count]
+
+
+def is_gzipped(filename):
+    with open(filename, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def open_sample(filename, **kwargs):
+    ''' Returns a reader for a Protobuf sample file, memory-mapping it instead
+        of decompressing it if it's stored uncompressed '''
+    if Path(filename).is_file() and not is_gzipped(filename):
+        from .mapped import MappedProtobufReader, is_sample
+        # anything else is left for gzip to reject
+        if is_sample(filename):
+            return MappedProtobufReader(filename, **kwargs)
+    return ProtobufReader(filename, **kwargs)
+
+
+reader_cls = open_sample
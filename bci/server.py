@@ -1,15 +1,38 @@
 import os
 import sys
+import asyncio
 import signal
+import time
 import struct
+import queue
+import hashlib
 import logging
 import threading
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 from furl import furl
 
-from .utils import Listener, UserData, Snapshot, VERSION, DATA_DIR, MSG_TYPES
+from .utils import (Listener, AsyncConnection, UserData, Snapshot, Have,
+                    Frame, FRAME_HEADER, FLAGS, VERSION, PROTOCOL_VERSION,
+                    DATA_DIR, MSG_TYPES, CODECS, SnapshotFile, snapshot_dir,
+                    snapshot_datetime)
+
+# messages handled at a time by the asyncio server
+PUBLISH_WORKERS = 32
+# connections served at a time by the threaded server, and accepted ones
+#  which may wait for a handler; clients beyond those are told to retry
+#  after RETRY_AFTER seconds
+HANDLERS = 256
+ACCEPT_QUEUE = 1024
+RETRY_AFTER = 1
+# seconds a rejected client may go quiet before its connection is closed
+REJECT_TIMEOUT = 1
+# seconds between checks of the worker processes, when running several
+WORKER_CHECK_INTERVAL = 1
+# message queue URL arguments passed on to the publisher (as publisher_<key>)
+PUBLISHER_ARGS = ('commit', 'batch', 'linger')
 
 
 def logger_init(name):
@@ -22,34 +45,191 @@ def logger_init(name):
     logging.getLogger("pika").propagate = False
 
 
-class Handler(threading.Thread):
-    lock = threading.Lock()
-
-    def __init__(self, connection, datapath, publish, **kwargs):
-        super().__init__()
-        self.connection, self.datapath, self.publish, self.kwargs = \
-            connection, datapath, publish, kwargs
+class Session:
+    ''' Serves a client's messages over a connection, from whichever thread
+        runs it; ends the process when the publisher service is unreachable
+        (see fail) '''
+    def __init__(self, connection, datapath, publish, publish_batch=None,
+                 **kwargs):
+        self.connection, self.datapath, self.publish = \
+            connection, datapath, publish
+        # publishers save snapshots under the server's datapath as well
+        self.kwargs = dict(kwargs, datapath=datapath)
+        # publishes several messages at once, if the publisher supports it
+        self.publish_batch = publish_batch
+        self.version = 1        # protocol version, until the client offers v2
+        self.sequence = None    # set once the client asks for pipelining
+        self.codec = None       # set once the client asks for compression
+        # the chunked snapshots being received, by user and stream
+        self.spools = {}
 
     def run(self):
-        # receive message from client
+        # serve messages until the client ends the session or disconnects;
+        #  older clients send a single message per connection; snapshots
+        #  left halfway through are discarded either way
+        with self.connection:
+            try:
+                self.serve_forever()
+            finally:
+                self.discard_spools()
+
+    def serve_forever(self):
+        while True:
+            # receive message from client
+            try:
+                message = self.connection.receive_message()
+            except EOFError:
+                return
+            except Exception as e:
+                self.connection.send_message(f'ERROR: {e.args[0]}')
+                return
+            try:
+                serving = self.serve(message)
+            except ConnectionError:
+                os._exit(1)
+            if not serving:
+                return
+
+    def serve(self, message):
+        # handles a message; returns False once the session is over
         try:
-            message = self.connection.receive_message()
-        except Exception as e:
-            self.connection.send_message(f'ERROR: {e.args[0]}')
-            return
+            frame = self.parse(message)
+        except Exception:
+            frame = self.unparsed(message)
+            if frame is None:
+                # there's no telling which message the error would answer,
+                #  so the session can't go on
+                return False
+            self.acknowledge(frame, 'ERROR deserializing message')
+            return True
+
+        if frame.msg_type == MSG_TYPES.END_SESSION:
+            return False
+        if frame.msg_type == MSG_TYPES.HELLO:
+            # answered in v1, as that's what the client waits for
+            version = self.pick_version(frame)
+            self.reply(frame, str(version))
+            self.version = version
+        elif frame.msg_type == MSG_TYPES.PIPELINE:
+            self.sequence = 0
+            self.reply(frame, 'OK!')
+        elif frame.msg_type == MSG_TYPES.COMPRESSION:
+            self.reply(frame, self.pick_codec(frame))
+        elif frame.msg_type == MSG_TYPES.LAST_SNAPSHOT:
+            self.reply(frame, str(self.last_snapshot(frame.user_id)))
+        elif frame.msg_type == MSG_TYPES.HAVE:
+            self.reply(frame, self.have(frame))
+
+        elif frame.msg_type == MSG_TYPES.SNAPSHOT_BATCH:
+            self.acknowledge(frame, self.handle_batch(frame))
+        elif frame.msg_type == MSG_TYPES.SNAPSHOT_CHUNK:
+            ack = self.handle_chunk(frame)
+            if ack is not None:
+                self.acknowledge(frame, ack)
+        else:
+            self.acknowledge(frame, self.handle(frame))
+        return True
+
+    def parse(self, message):
+        if self.version == 2:
+            return Frame.deserialize(message)
+        # in v1, once a codec was picked every snapshot is compressed
+        frame = Frame.from_message(message)
+        if self.codec and frame.msg_type == MSG_TYPES.SNAPSHOT:
+            frame.flags |= FLAGS.COMPRESSED
+        return frame
+
+    def unparsed(self, message):
+        # in v2, errors answering a message which can't be parsed carry its
+        #  stream and sequence number, if its header can be read at all
+        if self.version == 1:
+            return Frame(None, 0)
+        try:
+            _, _, msg_type, stream, sequence, user_id = \
+                FRAME_HEADER.unpack_from(message)
+        except struct.error:
+            return None
+        return Frame(msg_type, user_id, b'', stream, sequence)
+
+    def acknowledge(self, frame, ack):
+        # in v1, pipelined acks are preceded by a sequence number of their own
+        if self.version == 1 and self.sequence is not None:
+            self.sequence += 1
+            if isinstance(ack, str):
+                ack = ack.encode()
+            ack = struct.pack('<I', self.sequence) + ack
+        self.reply(frame, ack)
+
+    def reply(self, frame, answer):
+        # in v2, answers are sent as ack frames, of the same stream and with
+        #  the same sequence number as the frame they answer
+        if self.version == 2:
+            if isinstance(answer, str):
+                answer = answer.encode()
+            answer = Frame(MSG_TYPES.ACK, frame.user_id, answer, frame.stream,
+                           frame.sequence).serialize()
+        self.send(answer)
+
+    def send(self, message):
+        self.connection.send_message(message)
+
+    def pick_version(self, frame):
+        offered = [version for version in frame.payload
+                   if version <= PROTOCOL_VERSION]
+        return max(offered, default=1)
+
+    def pick_codec(self, frame):
+        for codec in bytes(frame.payload).decode().split(','):
+            if codec in CODECS:
+                self.codec = codec
+                return codec
+        return 'ERROR: no supported compression codec'
+
+    def last_snapshot(self, user_id):
+        user_dir = Path(self.datapath) / str(user_id)
+        last_datetime = 0
+        if user_dir.is_dir():
+            for user_snapshot_dir in user_dir.iterdir():
+                try:
+                    last_datetime = max(last_datetime,
+                                        snapshot_datetime(user_snapshot_dir))
+                except ValueError:
+                    continue
+        return last_datetime
+
+    def have(self, frame):
+        # digests of published snapshots are saved next to them, see handle()
+        answer = bytearray()
+        for timestamp, digest in Have.deserialize(frame.payload):
+            digest_path = snapshot_dir(frame.user_id, timestamp,
+                                       Path(self.datapath)) / 'snapshot.sha1'
+            answer.append(digest_path.exists()
+                          and digest_path.read_bytes() == digest)
+        return bytes(answer)
+
+    def save_digest(self, user_id, timestamp, digest):
+        datapath = snapshot_dir(user_id, timestamp, Path(self.datapath))
+        try:
+            datapath.mkdir(parents=True, exist_ok=True)
+            with open(datapath / 'snapshot.sha1', 'wb') as f:
+                f.write(digest)
+        except OSError as e:
+            logging.warning(f'could not save snapshot digest: {e}')
 
+    def handle(self, frame):
         # deserialize message using protobuf3
         try:
-            msg_type, user_id = struct.unpack('<IQ', message[:12])
+            msg_type, user_id = frame.msg_type, frame.user_id
+            payload = self.payload(frame)
             if msg_type == MSG_TYPES.USER_DATA:
-                message = UserData.deserialize(message[12:])
+                message = UserData.deserialize(payload)
             elif msg_type == MSG_TYPES.SNAPSHOT:
-                message = Snapshot.deserialize(message[12:])
+                raw_snapshot = payload
+                message = Snapshot.deserialize(raw_snapshot)
             else:
-                self.connection.send_message('ERROR: Unknown message type')
+                return 'ERROR: Unknown message type'
         except Exception:
-            self.connection.send_message('ERROR deserializing message')
-            return
+            return 'ERROR deserializing message'
 
         # publish message using the provided publish service
         try:
@@ -57,15 +237,174 @@ class Handler(threading.Thread):
             self.kwargs['user_id'] = user_id
             self.publish(message, **self.kwargs)
         except ConnectionError as e:
-            print(f'ERROR: {e.args[0]}', file=sys.stderr)
-            logging.critical(e.args[0])
-            self.connection.send_message(f'ERROR: {e.args[0]}')
-            os._exit(1)
+            self.fail(frame, e)
 
         except Exception as e:
-            self.connection.send_message(f'ERROR: {e.args[0]}')
-            return
-        self.connection.send_message('OK!')
+            return f'ERROR: {e.args[0]}'
+
+        # remember what was published, so identical re-uploads can be skipped
+        if msg_type == MSG_TYPES.SNAPSHOT:
+            self.save_digest(user_id, message.datetime,
+                             hashlib.sha1(raw_snapshot).digest())
+        return 'OK!'
+
+    def handle_batch(self, frame):
+        # acks a batch with one byte per snapshot, set if it was published
+        try:
+            raw_snapshots = Snapshot.split_batch(self.payload(frame))
+        except Exception:
+            return 'ERROR deserializing message'
+        messages = {}
+        for i, raw_snapshot in enumerate(raw_snapshots):
+            try:
+                messages[i] = Snapshot.deserialize(raw_snapshot)
+            except Exception:
+                continue
+
+        # the snapshots are published as any other snapshots, though all at
+        #  once if possible
+        published = bytearray(len(raw_snapshots))
+        self.kwargs['msg_type'] = MSG_TYPES.SNAPSHOT
+        self.kwargs['user_id'] = frame.user_id
+        try:
+            if self.publish_batch and messages:
+                self.publish_batch(list(messages.values()), **self.kwargs)
+                for i in messages:
+                    published[i] = True
+            else:
+                for i, message in messages.items():
+                    try:
+                        self.publish(message, **self.kwargs)
+                        published[i] = True
+                    except ConnectionError:
+                        raise
+                    except Exception as e:
+                        logging.warning(f'could not publish snapshot: {e}')
+        except ConnectionError as e:
+            self.fail(frame, e)
+
+        except Exception as e:
+            return f'ERROR: {e.args[0]}'
+
+        for i, message in messages.items():
+            if published[i]:
+                self.save_digest(frame.user_id, message.datetime,
+                                 hashlib.sha1(raw_snapshots[i]).digest())
+        return bytes(published)
+
+    def handle_chunk(self, frame):
+        # chunks of an oversized snapshot are spooled into its raw snapshot
+        #  file as they arrive, so it's never held in memory as a whole; it's
+        #  published and acked once its last chunk is in; snapshots sent over
+        #  different streams at once are spooled apart
+        key = frame.user_id, frame.stream
+        spool = self.spools.get(key)
+        try:
+            if not isinstance(spool, Exception):
+                payload = self.payload(frame)
+                if spool is None:
+                    timestamp, = struct.unpack_from('<Q', payload)
+                    spool = SnapshotFile(frame.user_id, timestamp,
+                                         Path(self.datapath))
+                    payload = payload[8:]
+                spool.write(payload)
+        except Exception as e:
+            if spool is not None:
+                spool.discard()
+            spool = e
+        if frame.flags & FLAGS.MORE:
+            self.spools[key] = spool
+            return None
+
+        self.spools.pop(key, None)
+        if isinstance(spool, Exception):
+            return f'ERROR: {spool.args[0]}'
+        # the snapshot isn't parsed, so publishers get its datetime and the
+        #  path of its raw snapshot file only
+        message = Snapshot()
+        message.datetime, message.path = spool.datetime, spool.path
+        self.kwargs['msg_type'] = MSG_TYPES.SNAPSHOT
+        self.kwargs['user_id'] = frame.user_id
+        try:
+            spool.close()
+            self.publish(message, **self.kwargs)
+        except ConnectionError as e:
+            self.fail(frame, e)
+
+        except Exception as e:
+            return f'ERROR: {e.args[0]}'
+        self.save_digest(frame.user_id, spool.datetime, spool.digest.digest())
+        return 'OK!'
+
+    def discard_spools(self):
+        # the session ended halfway through sending chunked snapshots
+        spools, self.spools = self.spools, {}
+        for spool in spools.values():
+            if isinstance(spool, SnapshotFile):
+                spool.discard()
+
+    def payload(self, frame):
+        if frame.flags & FLAGS.COMPRESSED:
+            _, decompress_func = CODECS[self.codec]
+            return decompress_func(frame.payload)
+        return frame.payload
+
+    def fail(self, frame, error):
+        # the publisher service is unreachable, so there's no point going on;
+        #  the client is told why before the serving loop ends the process
+        print(f'ERROR: {error.args[0]}', file=sys.stderr)
+        logging.critical(error.args[0])
+        self.reply(frame, f'ERROR: {error.args[0]}')
+        raise error
+
+
+class AsyncHandler(Session):
+    ''' Serves a connection as a coroutine rather than a thread of its own;
+        messages are handled by a shared, bounded pool of threads, as
+        handling them may block on the publisher or on disk '''
+    def __init__(self, connection, datapath, publish, publish_batch=None,
+                 executor=None, **kwargs):
+        super().__init__(connection, datapath, publish, publish_batch,
+                         **kwargs)
+        self.executor = executor
+        self.replies = []   # answers to the message being handled
+
+    async def serve_async(self):
+        async with self.connection:
+            try:
+                await self.serve_forever_async()
+            finally:
+                self.discard_spools()
+
+    async def serve_forever_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                message = await self.connection.receive_message()
+            except EOFError:
+                return
+            except Exception as e:
+                await self.connection.send_message(f'ERROR: {e.args[0]}')
+                return
+            try:
+                serving = await loop.run_in_executor(
+                    self.executor, self.serve, message)
+            except ConnectionError:
+                # the publisher service is unreachable, see fail()
+                await self.flush()
+                os._exit(1)
+            await self.flush()
+            if not serving:
+                return
+
+    async def flush(self):
+        replies, self.replies = self.replies, []
+        for reply in replies:
+            await self.connection.send_message(reply)
+
+    def send(self, message):
+        # replies are sent from the event loop once the message is handled
+        self.replies.append(message)
 
 
 def signal_handler(sig, frame):
@@ -86,7 +425,20 @@ def cli():
 @click.option('-h', '--host')
 @click.option('-p', '--port', type=int)
 @click.argument('message-queue-url')
-def run_server(host, port, message_queue_url):
+@click.option('-a', '--asyncio', 'use_asyncio', is_flag=True,
+              help='Serve connections from an event loop, not threads')
+@click.option('-W', '--workers', type=int, default=PUBLISH_WORKERS,
+              help='Max. number of messages handled at a time (with -a)')
+@click.option('-n', '--handlers', type=int, default=HANDLERS,
+              help='Max. number of connections served at a time')
+@click.option('-q', '--queue-size', type=int, default=ACCEPT_QUEUE,
+              help='Max. number of connections waiting to be served')
+@click.option('-P', '--processes', type=int, default=1,
+              help='Number of worker processes sharing the port')
+@click.option('-d', '--data-dir', type=click.Path(file_okay=False),
+              default=str(DATA_DIR), help='Directory to save snapshots in')
+def run_server(host, port, message_queue_url, use_asyncio, workers, handlers,
+               queue_size, processes, data_dir):
     logger_init('server')
     # retrieve publisher module
     message_queue_url = furl(message_queue_url)
@@ -102,8 +454,13 @@ def run_server(host, port, message_queue_url):
         return 1
     try:
         _run_server(host, port, publish=publisher.publish,
+                    publish_batch=getattr(publisher, 'publish_batch', None),
+                    use_asyncio=use_asyncio, workers=workers,
+                    handlers=handlers, queue_size=queue_size,
+                    processes=processes, datapath=Path(data_dir),
                     publisher_host=message_queue_url.host,
-                    publisher_port=message_queue_url.port)
+                    publisher_port=message_queue_url.port,
+                    **_publisher_args(message_queue_url))
     except Exception as error:
         if 'Temporary failure in name resolution' in str(error):
             error = f'unknown host name "{host}"'
@@ -112,7 +469,21 @@ def run_server(host, port, message_queue_url):
         return 1
 
 
-def _run_server(host=None, port=None, publish=None, **kwargs):
+def _publisher_args(message_queue_url):
+    # options of the publisher, passed in the message queue URL's query
+    args = {}
+    for key, value in message_queue_url.args.items():
+        if key not in PUBLISHER_ARGS:
+            logging.warning(f'ignoring unknown publisher option "{key}"')
+            continue
+        args[f'publisher_{key}'] = value
+    return args
+
+
+def _run_server(host=None, port=None, publish=None, publish_batch=None,
+                use_asyncio=False, workers=PUBLISH_WORKERS,
+                handlers=HANDLERS, queue_size=ACCEPT_QUEUE, processes=1,
+                datapath=DATA_DIR, **kwargs):
     logger_init('server')
     if not host:
         host = '127.0.0.1'
@@ -124,13 +495,151 @@ def _run_server(host=None, port=None, publish=None, **kwargs):
         logging.critical(f'{error}')
         return 1
 
-    listener = Listener(port=port, host=host)
+    def serve(listener):
+        _serve(listener, datapath, publish, publish_batch, use_asyncio,
+               workers, handlers, queue_size, **kwargs)
+
+    if processes <= 1:
+        listener = Listener(port=port, host=host)
+        with listener:
+            print('Press CTRL+C to exit')
+            serve(listener)
+        return
+
+    # each worker process listens on a socket of its own, bound to the same
+    #  address, and the kernel spreads connections between them; binding one
+    #  here first reports a bad address before any worker is started
+    with Listener(port=port, host=host, reuseport=True):
+        pass
+    print('Press CTRL+C to exit')
+    _supervise(processes, lambda: serve(
+        Listener(port=port, host=host, reuseport=True)))
+
+
+def _serve(listener, datapath, publish, publish_batch, use_asyncio, workers,
+           handlers, queue_size, **kwargs):
     with listener:
-        print('Press CTRL+C to exit')
+        if use_asyncio:
+            asyncio.run(_serve_async(listener, publish, publish_batch,
+                                     workers, datapath, **kwargs))
+            return
+
+        # a fixed pool of handlers serves accepted connections in turn; once
+        #  too many are waiting, new ones are turned away rather than letting
+        #  work pile up faster than it can be published
+        pending = queue.Queue(maxsize=max(queue_size, 1))
+
+        def serve():
+            while True:
+                session = Session(pending.get(), datapath, publish,
+                                  publish_batch, **kwargs)
+                try:
+                    session.run()
+                except Exception as e:
+                    logging.error(f'could not serve {session.connection!r}: '
+                                  f'{e}')
+
+        for _ in range(handlers):
+            threading.Thread(target=serve, daemon=True).start()
         while True:
             connection = listener.accept()
-            handler = Handler(connection, DATA_DIR, publish, **kwargs)
-            handler.start()
+            try:
+                pending.put_nowait(connection)
+            except queue.Full:
+                _reject(connection)
+
+
+def _supervise(processes, serve):
+    # forks the worker processes, and replaces those which exit; only the
+    #  workers are waited for, as the caller may have children of its own
+    workers = set()
+
+    def fork():
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(serve)
+        workers.add(pid)
+
+    try:
+        for _ in range(processes):
+            fork()
+        while True:
+            time.sleep(WORKER_CHECK_INTERVAL)
+            for pid in list(workers):
+                exited, status = os.waitpid(pid, os.WNOHANG)
+                if exited:
+                    workers.remove(pid)
+                    logging.warning(f'worker {pid} {_exit_status(status)}, '
+                                    f'restarting it')
+                    fork()
+    finally:
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+
+def _exit_status(status):
+    # describes a status returned by os.waitpid()
+    if os.WIFEXITED(status):
+        return f'exited with status {os.WEXITSTATUS(status)}'
+    return f'was killed by signal {os.WTERMSIG(status)}'
+
+
+def _run_worker(serve):
+    # runs in a forked worker, which must never return into the supervisor's
+    #  code; workers exit along with the supervisor, even if it's killed
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    supervisor = os.getppid()
+
+    def watch():
+        while os.getppid() == supervisor:
+            time.sleep(WORKER_CHECK_INTERVAL)
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True).start()
+    try:
+        serve()
+    except Exception as error:
+        logging.critical(f'worker {os.getpid()} failed: {error}')
+    finally:
+        os._exit(1)
+
+
+def _reject(connection):
+    # sent in place of the answer to the client's first message, whatever
+    #  it is, so clients needn't wait for anything else to tell; the message
+    #  itself is drained in the background, rather than holding up accepting
+    logging.warning(f'server is busy, rejecting {connection!r}')
+
+    def reject():
+        with connection:
+            try:
+                connection.send_message(f'BUSY retry-after {RETRY_AFTER}')
+            except OSError:
+                return
+            connection.drain(REJECT_TIMEOUT)
+
+    threading.Thread(target=reject, daemon=True).start()
+
+
+async def _serve_async(listener, publish, publish_batch=None,
+                       workers=PUBLISH_WORKERS, datapath=DATA_DIR, **kwargs):
+    # a coroutine per connection instead of a thread, so the number of
+    #  connections served at once is bounded by memory alone
+    executor = ThreadPoolExecutor(workers)
+
+    async def serve(reader, writer):
+        listener.configure(writer.get_extra_info('socket'))
+        handler = AsyncHandler(AsyncConnection(reader, writer), datapath,
+                               publish, publish_batch, executor, **kwargs)
+        try:
+            await handler.serve_async()
+        except Exception as e:
+            logging.error(f'could not serve {handler.connection!r}: {e}')
+
+    server = await asyncio.start_server(serve, sock=listener.socket,
+                                        backlog=listener.backlog)
+    async with server:
+        await server.serve_forever()
 
 
 # API function aliases
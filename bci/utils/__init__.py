@@ -1,6 +1,11 @@
 from .listener import Listener              # noqa
-from .connection import Connection          # noqa
+from .connection import Connection, AsyncConnection, FramedConnection  # noqa
 from .reader import BinaryReader, ProtobufReader                # noqa
-from .protocol import UserData, Snapshot    # noqa
+from .protocol import (UserData, Snapshot, FlatSnapshot, EndSession,  # noqa
+                       Pipeline, LastSnapshot, Compression, Have, Hello,
+                       Frame, FRAME_HEADER, FLAGS, is_flat, message_parts,
+                       message_size)
+from .compression import CODECS, compress, decompress      # noqa
+from .storage import snapshot_dir, snapshot_datetime, SnapshotFile  # noqa
 # from .parsers import TranslationParser, ColorImageParser        # noqa
 from .constants import *                    # noqa
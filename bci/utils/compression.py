@@ -0,0 +1,36 @@
+import zlib
+
+from .protocol import message_parts
+
+# codecs available for compressing snapshots on the wire, by name; zstd and
+#  lz4 are only offered when their (optional) packages are installed
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 1), zlib.decompress),
+}
+
+try:
+    import zstandard
+    CODECS['zstd'] = (
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+except ImportError:
+    pass
+
+try:
+    import lz4.frame
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+
+def compress(codec, message):
+    # leave the message header (type and user ID) as is, in a part of its own
+    compress_func, _ = CODECS[codec]
+    header, payload = message_parts(message)
+    return [header, compress_func(payload)]
+
+
+def decompress(codec, message):
+    _, decompress_func = CODECS[codec]
+    return message[:12] + decompress_func(message[12:])
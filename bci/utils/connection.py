@@ -1,5 +1,10 @@
 import struct
 import socket
+import asyncio
+
+from .protocol import Frame
+
+RECV_CHUNK_SIZE = 2**20
 
 
 class Connection:
@@ -22,12 +27,17 @@ class Connection:
         self.socket.sendall(data)
 
     def send_message(self, message):
-        if type(message) == str:
-            message = message.encode('utf8')
-        msg_size = len(message)    # data should be binary
-
-        msg_header = struct.pack('<I', msg_size)
-        self.socket.sendall(msg_header + message)
+        # send the header and the message (or the parts it's given in, such
+        #  as a frame's header and payload) as separate buffers of a single
+        #  call, rather than copying the message just to prepend the header
+        parts = _parts(message)
+        buffers = [struct.pack('<I', sum(map(len, parts)))] + parts
+        while buffers:
+            sent = self.socket.sendmsg(buffers)
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            if sent:
+                buffers[0] = buffers[0][sent:]
 
     def receive(self, size):
         data = self.socket.recv(size)
@@ -36,23 +46,158 @@ class Connection:
         return data
 
     def receive_message(self):
-        msg_size = self.socket.recv(4)
+        msg_size = bytearray(4)
+        received = self._receive_into(memoryview(msg_size))
+        if not received:
+            raise EOFError('connection closed by peer')
+        if received != len(msg_size):
+            raise Exception('data is incomplete')
         msg_size, = struct.unpack('<I', msg_size)
-        data = bytes()
-        while len(data) < msg_size:
-            new_data = self.socket.recv(1024)
+        # fill the message in place rather than concatenating chunks, and
+        #  return it as is (a bytearray)
+        data = bytearray(msg_size)
+        with memoryview(data) as view:
+            if self._receive_into(view) != msg_size:
+                raise Exception('data is incomplete')
+        return data
+
+    def _receive_into(self, view):
+        # never read past the end of the view, as the peer may have already
+        #  sent the next message; returns the number of bytes received
+        received = 0
+        while received < len(view):
+            new_data = self.socket.recv_into(
+                view[received:], min(RECV_CHUNK_SIZE, len(view) - received))
             if not new_data:
                 break
-            data += new_data
-        if len(data) != msg_size:
-            raise Exception('data is incomplete')
-        return data
+            received += new_data
+        return received
+
+    def drain(self, timeout):
+        # tells the peer nothing more is coming, then discards whatever it
+        #  still sends until it closes its end (or goes quiet), as closing a
+        #  socket with unread data resets the connection under the peer
+        try:
+            self.socket.shutdown(socket.SHUT_WR)
+            self.socket.settimeout(timeout)
+            while self.socket.recv(RECV_CHUNK_SIZE):
+                pass
+        except OSError:
+            pass
 
     def close(self):
         self.socket.close()
 
     @classmethod
-    def connect(cls, host, port):
+    def connect(cls, host, port, nodelay=False, sndbuf=None, rcvbuf=None,
+                keepalive=False):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        configure_socket(sock, nodelay, sndbuf, rcvbuf, keepalive)
         sock.connect((host, port))
         return Connection(sock)
+
+
+def configure_socket(sock, nodelay=False, sndbuf=None, rcvbuf=None,
+                     keepalive=False):
+    ''' Sets TCP options on a socket; buffer sizes (in bytes) left as None
+        keep the system's defaults '''
+    if nodelay:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if sndbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    if keepalive:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+
+def _parts(message):
+    # a message as a list of byte buffers, however it's given
+    if isinstance(message, str):
+        message = message.encode('utf8')
+    if not isinstance(message, (list, tuple)):
+        message = [message]
+    return [memoryview(part).cast('B') for part in message]
+
+
+class FramedConnection:
+    ''' Wraps a connection over which protocol v2 was negotiated, sending v1
+        messages as v2 frames of a stream and unwrapping the answers '''
+    def __init__(self, connection, stream=0):
+        self.connection = connection
+        self.stream = stream
+
+    def __repr__(self):
+        return f'<FramedConnection of stream {self.stream} over ' \
+               f'{self.connection!r}>'
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exception, error, traceback):
+        self.close()
+
+    def send_message(self, message, sequence=0, flags=0):
+        frame = Frame.from_message(message, self.stream, sequence, flags)
+        self.connection.send_message(frame.serialize_parts())
+
+    def receive_message(self):
+        # acks of sequenced frames are prefixed with their sequence number,
+        #  just like pipelined acks in v1
+        frame = Frame.deserialize(self.connection.receive_message())
+        if frame.sequence:
+            return struct.pack('<I', frame.sequence) + frame.payload
+        return bytes(frame.payload)
+
+    def close(self):
+        self.connection.close()
+
+
+class AsyncConnection:
+    def __init__(self, reader, writer):
+        self.reader, self.writer = reader, writer
+
+    def __repr__(self):
+        sockname = self.writer.get_extra_info('sockname')
+        peername = self.writer.get_extra_info('peername')
+        return '<AsyncConnection from %s to %s>' % (
+            ':'.join(str(arg) for arg in sockname),
+            ':'.join(str(arg) for arg in peername),
+        )
+
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, exception, error, traceback):
+        await self.close()
+
+    async def send_message(self, message):
+        parts = _parts(message)
+        self.writer.write(struct.pack('<I', sum(map(len, parts))))
+        self.writer.writelines(parts)
+        await self.writer.drain()
+
+    async def receive_message(self):
+        try:
+            msg_size = await self.reader.readexactly(4)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                raise EOFError('connection closed by peer')
+            raise Exception('data is incomplete')
+        msg_size, = struct.unpack('<I', msg_size)
+        try:
+            return await self.reader.readexactly(msg_size)
+        except asyncio.IncompleteReadError:
+            raise Exception('data is incomplete')
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionResetError:
+            pass    # closed by the peer first, which is just as good
+
+    @classmethod
+    async def connect(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return AsyncConnection(reader, writer)
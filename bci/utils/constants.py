@@ -1,6 +1,8 @@
 from pathlib import Path
 
 VERSION = 1.0
+PROTOCOL_VERSION = 2    # latest wire protocol version; see protocol.Frame
+CHUNK_SIZE = 4 * 2**20  # larger snapshots are sent in chunks of this size
 DEFAULT_FORMAT = 'protobuf'
 DATA_DIR = Path(__file__).parent.parent.parent / 'data'
 SNAPSHOT_TOPICS = ['feelings', 'pose', 'color_image', 'depth_image']
@@ -10,3 +12,12 @@ TOPICS = SNAPSHOT_TOPICS + ['users', 'snapshots']
 class MSG_TYPES:
     USER_DATA = 1
     SNAPSHOT = 2
+    END_SESSION = 3
+    PIPELINE = 4
+    LAST_SNAPSHOT = 5
+    COMPRESSION = 6
+    HAVE = 7
+    HELLO = 8
+    ACK = 9
+    SNAPSHOT_BATCH = 10
+    SNAPSHOT_CHUNK = 11
@@ -1,13 +1,23 @@
-from .connection import Connection
+from .connection import Connection, configure_socket
 import socket
 
 
 class Listener:
-    def __init__(self, /, port, host='0.0.0.0', backlog=1000, reuseaddr=True): # noqa
+    def __init__(self, /, port, host='0.0.0.0', backlog=1000, reuseaddr=True, # noqa
+                 nodelay=False, sndbuf=None, rcvbuf=None, keepalive=False,
+                 reuseport=False):
         self.port = port
         self.host = host
         self.backlog = backlog
         self.reuseaddr = reuseaddr
+        # lets several listeners bind the same address, with the kernel
+        #  spreading incoming connections between them
+        self.reuseport = reuseport
+        # TCP options for accepted connections (see configure_socket)
+        self.nodelay = nodelay
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.keepalive = keepalive
 
     def __repr__(self):
         return f'Listener(port={self.port}, host=\'{self.host}\', ' \
@@ -23,12 +33,21 @@ class Listener:
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         if self.reuseaddr:
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuseport:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # buffer sizes must be set before listening to take full effect
+        self.configure(self.socket)
         self.socket.bind((self.host, self.port))
         self.socket.listen(self.backlog)   # max. connections
 
+    def configure(self, sock):
+        configure_socket(sock, self.nodelay, self.sndbuf, self.rcvbuf,
+                         self.keepalive)
+
     def stop(self):
         self.socket.close()
 
     def accept(self):
         connection, _ = self.socket.accept()
+        self.configure(connection)
         return Connection(connection)
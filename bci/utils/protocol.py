@@ -1,9 +1,26 @@
 import io
 import struct
+from types import SimpleNamespace
 
-from ..utils.constants import MSG_TYPES
+import numpy as np
+
+from ..utils.constants import MSG_TYPES, PROTOCOL_VERSION
 from ..utils.protobuf import cortex_pb2
 
+# version, flags, message type, stream ID, sequence number and user ID
+FRAME_HEADER = struct.Struct('<BBHIIQ')
+# magic, header size, datetime, translation (x, y, z), rotation (x, y, z, w),
+#  feelings, color and depth image sizes, and color and depth data offsets
+FLAT_MAGIC = b'BCIF'
+FLAT_HEADER = struct.Struct('<4sIQ3d4d4f4I2Q')
+FLAT_ALIGNMENT = 64
+
+
+class FLAGS:
+    COMPRESSED = 0x01   # payload compressed with the negotiated codec
+    BATCH = 0x02        # payload holds several messages of the same type
+    MORE = 0x04         # payload is a chunk of a message, more chunks follow
+
 
 class UserData:
     def __init__(self, reader=None):
@@ -58,12 +75,21 @@ class Snapshot:
         self.feelings = None
 
     def serialize(self):
-        message = bytes()
+        return b''.join(self.serialize_parts())
+
+    def serialize_parts(self):
+        # the message header and the snapshot, as separate buffers which are
+        #  sent as they are (see Connection.send_message), so that forwarded
+        #  snapshots are never copied
 
         # Have any message begin with an unsigned 64-bit int containing the
         #  user's ID. this is done so the server won't have to manage a session
         #  with a specific user while receiving snapshots
-        message += struct.pack('<IQ', MSG_TYPES.SNAPSHOT, self.user_id)
+        header = struct.pack('<IQ', MSG_TYPES.SNAPSHOT, self.user_id)
+
+        # Snapshots read as raw protobuf3 data are forwarded as they are
+        if isinstance(self.snapshot_data, (bytes, bytearray, memoryview)):
+            return [header, self.snapshot_data]
 
         # Serialize the snapshot using protobuf3
         # Have an unsigned int with the packed snapshot size precede it
@@ -98,21 +124,292 @@ class Snapshot:
         feelings.exhaustion = snapshot.feelings.exhaustion
         feelings.happiness = snapshot.feelings.happiness
 
-        packed = packed.SerializeToString()
-        message += packed
-        return message
+        return [header, packed.SerializeToString()]
+
+    def get_datetime(self):
+        if isinstance(self.snapshot_data, (bytes, bytearray, memoryview)):
+            if is_flat(self.snapshot_data):
+                return struct.unpack_from('<Q', self.snapshot_data, 8)[0]
+            # the datetime is normally serialized first, as a varint-encoded
+            #  field #1, so there's no need to parse the whole snapshot
+            raw_data = self.snapshot_data
+            if raw_data[:1] == b'\x08':
+                snapshot_datetime, shift = 0, 0
+                for byte in bytes(raw_data[1:11]):
+                    snapshot_datetime |= (byte & 0x7f) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        return snapshot_datetime
+            parsed_snapshot = cortex_pb2.Snapshot()
+            parsed_snapshot.ParseFromString(self.snapshot_data)
+            return parsed_snapshot.datetime
+        return self.snapshot_data.datetime
+
+    @classmethod
+    def serialize_batch(cls, user_id, snapshots_data):
+        # Packs several snapshots (parsed or raw) into a single message, each
+        #  preceded by its size, so they take a single round trip to publish
+        parts = [struct.pack('<IQ', MSG_TYPES.SNAPSHOT_BATCH, user_id)]
+        for snapshot_data in snapshots_data:
+            if not isinstance(snapshot_data, (bytes, bytearray, memoryview)):
+                snapshot_data = cls(user_id, snapshot_data).serialize()[12:]
+            parts += [struct.pack('<I', len(snapshot_data)), snapshot_data]
+        return b''.join(parts)
+
+    @classmethod
+    def split_batch(cls, raw_data):
+        ''' Returns the raw snapshots of a batch, as slices of it '''
+        raw_data, offset, raw_snapshots = memoryview(raw_data), 0, []
+        while offset < len(raw_data):
+            size, = struct.unpack_from('<I', raw_data, offset)
+            offset += 4
+            if offset + size > len(raw_data):
+                raise Exception('snapshot batch is incomplete')
+            raw_snapshots.append(raw_data[offset:offset + size])
+            offset += size
+        return raw_snapshots
+
+    @classmethod
+    def serialize_chunks(cls, message, chunk_size):
+        # Splits a serialized snapshot into chunk messages holding up to
+        #  chunk_size bytes of it each, preceded by one holding only the
+        #  snapshot's datetime, so that no chunk is copied to prepend it;
+        #  yields them (in parts) along with whether more chunks follow
+        header, raw_data = message_parts(message)
+        user_id, = struct.unpack_from('<Q', header, 4)
+        header = struct.pack('<IQ', MSG_TYPES.SNAPSHOT_CHUNK, user_id)
+        snapshot_datetime = cls(user_id, raw_data).get_datetime()
+        yield [header, struct.pack('<Q', snapshot_datetime)], len(raw_data) > 0
+        for offset in range(0, len(raw_data), chunk_size):
+            yield [header, raw_data[offset:offset + chunk_size]], \
+                offset + chunk_size < len(raw_data)
+
+    @classmethod
+    def deserialize_batch(cls, raw_data):
+        return [cls.deserialize(raw_snapshot)
+                for raw_snapshot in cls.split_batch(raw_data)]
 
     @classmethod
     def deserialize(cls, raw_data):
         ''' This happens on server-side'''
-        bytereader = io.BytesIO(raw_data)
-
+        if is_flat(raw_data):
+            return FlatSnapshot.deserialize(raw_data)
         parsed_snapshot = cortex_pb2.Snapshot()
-        parsed_snapshot.ParseFromString(bytereader.read())
+        parsed_snapshot.ParseFromString(raw_data)
         snapshot = Snapshot()
+        # kept so the snapshot may be saved without serializing it again
+        snapshot.raw_data = raw_data
         snapshot.datetime = parsed_snapshot.datetime
         snapshot.pose = parsed_snapshot.pose
         snapshot.color_image = parsed_snapshot.color_image
         snapshot.depth_image = parsed_snapshot.depth_image
         snapshot.feelings = parsed_snapshot.feelings
         return snapshot
+
+
+class FlatSnapshot:
+    ''' The fixed-layout snapshot encoding: a header holding the snapshot's
+        datetime, pose, feelings and image sizes, followed by the color
+        image's bytes and the depth image's float32 values, each at an aligned
+        offset, so they may be viewed with numpy rather than decoded '''
+    def __init__(self, snapshot_data=None):
+        self.snapshot_data = snapshot_data
+
+    def serialize(self):
+        snapshot = self.snapshot_data
+        if isinstance(snapshot, (bytes, bytearray, memoryview)):
+            if is_flat(snapshot):
+                return snapshot
+            snapshot = cortex_pb2.Snapshot()
+            snapshot.ParseFromString(self.snapshot_data)
+        color, depth = snapshot.color_image, snapshot.depth_image
+        color_offset = _align(FLAT_HEADER.size)
+        depth_offset = _align(color_offset + len(color.data))
+        translation, rotation = snapshot.pose.translation, \
+            snapshot.pose.rotation
+        feelings = snapshot.feelings
+        message = bytearray(depth_offset + 4 * len(depth.data))
+        FLAT_HEADER.pack_into(
+            message, 0, FLAT_MAGIC, FLAT_HEADER.size, snapshot.datetime,
+            translation.x, translation.y, translation.z,
+            rotation.x, rotation.y, rotation.z, rotation.w,
+            feelings.hunger, feelings.thirst, feelings.exhaustion,
+            feelings.happiness, color.height, color.width,
+            depth.height, depth.width, color_offset, depth_offset)
+        message[color_offset:color_offset + len(color.data)] = color.data
+        message[depth_offset:] = np.asarray(depth.data, '<f4').tobytes()
+        return message
+
+    @classmethod
+    def deserialize(cls, raw_data):
+        ''' Returns a snapshot with the same fields as a parsed one, whose
+            images' data are views of raw_data '''
+        raw_data = memoryview(raw_data).cast('B')
+        _, _, datetime, *pose, hunger, thirst, exhaustion, happiness, \
+            color_height, color_width, depth_height, depth_width, \
+            color_offset, depth_offset = FLAT_HEADER.unpack_from(raw_data)
+        color_size = color_height * color_width * 3
+        depth_count = depth_height * depth_width
+        if color_offset + color_size > len(raw_data) or \
+                depth_offset + 4 * depth_count > len(raw_data):
+            raise Exception('snapshot data is incomplete')
+
+        snapshot = FlatSnapshot()
+        snapshot.raw_data = raw_data
+        snapshot.datetime = datetime
+        snapshot.pose = SimpleNamespace(
+            translation=SimpleNamespace(x=pose[0], y=pose[1], z=pose[2]),
+            rotation=SimpleNamespace(x=pose[3], y=pose[4], z=pose[5],
+                                     w=pose[6]))
+        snapshot.color_image = SimpleNamespace(
+            height=color_height, width=color_width,
+            data=raw_data[color_offset:color_offset + color_size])
+        snapshot.depth_image = SimpleNamespace(
+            height=depth_height, width=depth_width,
+            data=np.frombuffer(raw_data, '<f4', depth_count, depth_offset))
+        snapshot.feelings = SimpleNamespace(
+            hunger=hunger, thirst=thirst, exhaustion=exhaustion,
+            happiness=happiness)
+        return snapshot
+
+
+def message_parts(message):
+    ''' Returns the header (type and user ID) and the payload of a message,
+        serialized either in one piece or as a pair of them (see
+        Connection.send_message), without copying either '''
+    if isinstance(message, (list, tuple)):
+        header, payload = message
+        return header, memoryview(payload).cast('B')
+    message = memoryview(message).cast('B')
+    return message[:12], message[12:]
+
+
+def message_size(message):
+    header, payload = message_parts(message)
+    return len(header) + len(payload)
+
+
+def is_flat(raw_data):
+    return bytes(raw_data[:4]) == FLAT_MAGIC
+
+
+def _align(offset):
+    return -(-offset // FLAT_ALIGNMENT) * FLAT_ALIGNMENT
+
+
+class EndSession:
+    def __init__(self, user_id=None):
+        self.user_id = user_id
+
+    def serialize(self):
+        # An empty message which tells the server that no more messages will
+        #  be sent over the current connection
+        return struct.pack('<IQ', MSG_TYPES.END_SESSION, self.user_id)
+
+
+class Pipeline:
+    def __init__(self, user_id=None, window=1):
+        self.user_id = user_id
+        self.window = window
+
+    def serialize(self):
+        # Asks the server to prefix every following ack with the sequence
+        #  number of the message it acknowledges, so the client may send up
+        #  to `window` snapshots before waiting for their acks
+        return struct.pack('<IQI', MSG_TYPES.PIPELINE, self.user_id,
+                           self.window)
+
+
+class LastSnapshot:
+    def __init__(self, user_id=None):
+        self.user_id = user_id
+
+    def serialize(self):
+        # Asks the server for the datetime of the latest snapshot it holds for
+        #  the user, so an interrupted upload may skip what it already sent
+        return struct.pack('<IQ', MSG_TYPES.LAST_SNAPSHOT, self.user_id)
+
+
+class Compression:
+    def __init__(self, user_id=None, codecs=()):
+        self.user_id = user_id
+        self.codecs = codecs
+
+    def serialize(self):
+        # Offers the server a list of codecs, by order of preference; the
+        #  server answers with the one it picked for compressing snapshots
+        message = struct.pack('<IQ', MSG_TYPES.COMPRESSION, self.user_id)
+        message += ','.join(self.codecs).encode()
+        return message
+
+
+class Have:
+    def __init__(self, user_id=None, digests=()):
+        self.user_id = user_id
+        self.digests = digests
+
+    def serialize(self):
+        # Lists (datetime, SHA-1 digest) pairs of snapshots about to be sent;
+        #  the server answers with one byte per snapshot, set if it already
+        #  holds an identical snapshot
+        return b''.join([struct.pack('<IQ', MSG_TYPES.HAVE, self.user_id)] + [
+            struct.pack('<Q20s', snapshot_datetime, digest)
+            for snapshot_datetime, digest in self.digests])
+
+    @classmethod
+    def deserialize(cls, raw_data):
+        return [struct.unpack_from('<Q20s', raw_data, offset)
+                for offset in range(0, len(raw_data), 28)]
+
+
+class Hello:
+    def __init__(self, user_id=None, versions=(PROTOCOL_VERSION,)):
+        self.user_id = user_id
+        self.versions = versions
+
+    def serialize(self):
+        # Offers the server the protocol versions the client speaks, as one
+        #  byte each; the server answers with the one it picked, and servers
+        #  which only speak v1 reject the message, so both sides stay with v1
+        message = struct.pack('<IQ', MSG_TYPES.HELLO, self.user_id)
+        return message + bytes(self.versions)
+
+
+class Frame:
+    ''' A protocol v2 message: the v1 header (type and user ID) extended with
+        the protocol version, flags, and the stream and sequence number the
+        frame belongs to, which its ack frame carries back '''
+    def __init__(self, msg_type, user_id, payload=b'', stream=0, sequence=0,
+                 flags=0):
+        self.msg_type = msg_type
+        self.user_id = user_id
+        self.payload = payload
+        self.stream = stream
+        self.sequence = sequence
+        self.flags = flags
+
+    def serialize(self):
+        return b''.join(self.serialize_parts())
+
+    def serialize_parts(self):
+        # the header and the payload, as separate buffers which are sent as
+        #  they are (see Connection.send_message), so the payload isn't copied
+        header = FRAME_HEADER.pack(PROTOCOL_VERSION, self.flags, self.msg_type,
+                                   self.stream, self.sequence, self.user_id)
+        return [header, self.payload]
+
+    @classmethod
+    def deserialize(cls, raw_data):
+        version, flags, msg_type, stream, sequence, user_id = \
+            FRAME_HEADER.unpack_from(raw_data)
+        if version != PROTOCOL_VERSION:
+            raise Exception(f'unsupported protocol version {version}')
+        return cls(msg_type, user_id, memoryview(raw_data)[FRAME_HEADER.size:],
+                   stream, sequence, flags)
+
+    @classmethod
+    def from_message(cls, message, stream=0, sequence=0, flags=0):
+        # wraps a v1 message, as serialized by any of the classes above
+        header, payload = message_parts(message)
+        msg_type, user_id = struct.unpack_from('<IQ', header)
+        return cls(msg_type, user_id, payload, stream, sequence, flags)
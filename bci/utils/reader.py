@@ -33,23 +33,17 @@ class BinaryReader:
                 rotation = struct.unpack('dddd', self.fp.read(32))
                 color_height, color_width = struct.unpack('II',
                                                           self.fp.read(8))
-                # parse color image
-                color_pixels = []
-                for _ in range(color_height):
-                    for _ in range(color_width):
-                        B, G, R = struct.unpack('BBB', self.fp.read(3))
-                        color_pixels.append((R, G, B))  # fix pixel byte order
-                image = Image.new('RGB', (color_width, color_height))
-                image.putdata(color_pixels)
+                # parse color image, fixing the pixels' byte order (BGR)
+                color = np.frombuffer(
+                    self.fp.read(color_height * color_width * 3), np.uint8)
+                image = Image.fromarray(np.ascontiguousarray(
+                    color.reshape(color_height, color_width, 3)[..., ::-1]))
                 image.save(f'{save_dir}/color_image_{idx}.jpg')
                 # parse depth image
                 depth_height, depth_width = struct.unpack('II',
                                                           self.fp.read(8))
-                depth_pixels = []
-                for _ in range(depth_height):
-                    for _ in range(depth_width):
-                        depth_pixels.append(struct.unpack('f',
-                                                          self.fp.read(4)), )
+                # (depth values aren't displayed, only skipped over)
+                self.fp.read(depth_height * depth_width * 4)
                 # parse feelings
                 hunger, thirst, exhaustion, happiness = \
                     struct.unpack('ffff', self.fp.read(16))
@@ -105,16 +99,9 @@ class ProtobufReader:
                 snapshot.ParseFromString(self.fp.read(msg_size))
 
                 # parse color image
-                color_pixels = []
-                pixel = []
-                for byte in snapshot.color_image.data:
-                    pixel.append(byte)
-                    if len(pixel) == 3:
-                        color_pixels.append(tuple(pixel))
-                        pixel = []
-                image = Image.new('RGB', (snapshot.color_image.width,
-                                          snapshot.color_image.height))
-                image.putdata(color_pixels)
+                image = Image.frombytes('RGB', (snapshot.color_image.width,
+                                                snapshot.color_image.height),
+                                        snapshot.color_image.data)
                 image.save(f'{save_dir}/color_image_{idx}.jpg')
 
                 # parse depth image
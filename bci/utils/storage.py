@@ -0,0 +1,47 @@
+import hashlib
+import os
+from datetime import datetime
+
+from .constants import DATA_DIR
+
+# raw snapshots are saved under <data dir>/<user ID>/<timestamp>
+SNAPSHOT_DIR_FORMAT = '%Y-%m-%d_%H-%M-%S-%f'
+
+
+def snapshot_dir(user_id, snapshot_datetime, data_dir=DATA_DIR):
+    timestamp = datetime.fromtimestamp(snapshot_datetime/1000)
+    timestamp = timestamp.strftime(SNAPSHOT_DIR_FORMAT)[:-3]
+    return data_dir / str(user_id) / timestamp
+
+
+def snapshot_datetime(snapshot_dir):
+    # the inverse of snapshot_dir(), for a snapshot's directory name
+    timestamp = datetime.strptime(snapshot_dir.name, SNAPSHOT_DIR_FORMAT)
+    return round(timestamp.timestamp() * 1000)
+
+
+class SnapshotFile:
+    ''' Writes a raw snapshot piece by piece next to its directory, moving it
+        in place once it's complete; the directory itself only exists from
+        then on, as it's what tells the snapshot was received '''
+    def __init__(self, user_id, snapshot_datetime, data_dir=DATA_DIR):
+        self.datetime = snapshot_datetime
+        self.path = snapshot_dir(user_id, snapshot_datetime,
+                                 data_dir) / 'snapshot.raw'
+        self.partial_path = self.path.parent.with_suffix('.part')
+        self.partial_path.parent.mkdir(parents=True, exist_ok=True)
+        self.fp = open(self.partial_path, 'wb')
+        self.digest = hashlib.sha1()
+
+    def write(self, data):
+        self.fp.write(data)
+        self.digest.update(data)
+
+    def close(self):
+        self.fp.close()
+        self.path.parent.mkdir(exist_ok=True)
+        os.replace(self.partial_path, self.path)
+
+    def discard(self):
+        self.fp.close()
+        self.partial_path.unlink(missing_ok=True)
@@ -1,14 +1,21 @@
 import os
 import sys
+import time
+import socket
+import threading
 import subprocess
+from types import SimpleNamespace
 
 import gzip
 import pytest
 import struct
 
 WAIT_INTERVAL = 1
+LONG_SAMPLE_SNAPSHOTS = 10
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bci.server import run_server           # noqa
+from bci.utils import MSG_TYPES             # noqa
 from bci.utils.protobuf import cortex_pb2   # noqa
 
 
@@ -21,6 +28,16 @@ def capture(command, run_in_bg=False):
     return proc
 
 
+class _User:
+    user_id, username, birthdate, gender = 123, 'Test Testenson', 0, 'male'
+
+
+def _raw_snapshot(datetime):
+    snapshot = cortex_pb2.Snapshot()
+    snapshot.datetime = datetime
+    return snapshot.SerializeToString()
+
+
 @pytest.fixture
 def prepare_good_protofile():
     raw_data = bytes()
@@ -73,3 +90,58 @@ def prepare_bad_protofile():
 def prepare_unzipped_protofile():
     with open("tests/unzipped_proto.mind.gz", "wb") as f:
         f.write(b'garbage data')
+
+
+@pytest.fixture
+def prepare_long_protofile(tmp_path):
+    # LONG_SAMPLE_SNAPSHOTS snapshots, a second apart and growing in size
+    user_data = cortex_pb2.User()
+    user_data.user_id = 123
+    user_data.username = 'Test Testenson'
+    raw_user_data = user_data.SerializeToString()
+    raw_data = struct.pack('I', len(raw_user_data)) + raw_user_data
+    for i in range(LONG_SAMPLE_SNAPSHOTS):
+        snapshot = cortex_pb2.Snapshot()
+        snapshot.datetime = 60000 + 1000 * i
+        snapshot.color_image.width = i + 1
+        snapshot.color_image.height = 1
+        snapshot.color_image.data = b'000' * (i + 1)
+        snapshot.feelings.hunger = i / LONG_SAMPLE_SNAPSHOTS
+        raw_snapshot = snapshot.SerializeToString()
+        raw_data += struct.pack('I', len(raw_snapshot)) + raw_snapshot
+
+    path = tmp_path / 'long_proto.mind.gz'
+    with gzip.GzipFile(path, 'wb') as f:
+        f.write(raw_data)
+    return path
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def stub_server(tmp_path):
+    # runs a server on a thread, saving into a directory of its own, whose
+    #  publisher records the type of every message it publishes, the
+    #  snapshots, and the size of every batch
+    server = SimpleNamespace(port=_free_port(), datapath=tmp_path / 'data',
+                             messages=[], snapshots=[], batches=[])
+
+    def publish(message, **kwargs):
+        server.messages.append(kwargs['msg_type'])
+        if kwargs['msg_type'] == MSG_TYPES.SNAPSHOT:
+            server.snapshots.append(message)
+
+    def publish_batch(messages, **kwargs):
+        server.batches.append(len(messages))
+        for message in messages:
+            publish(message, **kwargs)
+    threading.Thread(target=run_server, kwargs={
+        'host': '127.0.0.1', 'port': server.port, 'publish': publish,
+        'publish_batch': publish_batch, 'datapath': server.datapath
+    }, daemon=True).start()
+    time.sleep(WAIT_INTERVAL)
+    return server
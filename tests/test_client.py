@@ -1,8 +1,24 @@
+import gzip
+import json
+import hashlib
+import socket
+import struct
 import time
+import asyncio
+import threading
 from pathlib import Path
 
-from bci.client import upload_sample
-from conftest import capture, WAIT_INTERVAL
+import pytest
+
+from bci.client import (Checkpoint, upload_sample, upload_sample_async,
+                        _connect, _open_session, _send_snapshots)
+from bci.readers.protobuf import ProtobufReader
+from bci.server import _reject
+from bci.utils import (Connection, FlatSnapshot, Listener, Snapshot, UserData,
+                       MSG_TYPES)
+from bci.utils.storage import snapshot_dir
+from conftest import capture, _free_port, _User, _raw_snapshot, \
+    LONG_SAMPLE_SNAPSHOTS, WAIT_INTERVAL
 
 log_path = Path(__file__).parents[1] / "log" / "client.log"
 
@@ -166,3 +182,382 @@ def test_client_help():
     assert client_proc.returncode == 0
     assert b'Usage: bci.client [OPTIONS] COMMAND [ARGS]' in out
     assert b'upload-sample' in out
+
+
+def test_upload_sample_session(prepare_good_protofile, stub_server):
+    client_proc = capture(f"python -m bci.client upload-sample "
+                          f"-h '127.0.0.1' -p {stub_server.port} -s "
+                          f"tests/good_proto.mind.gz")
+    out, err = client_proc.communicate()
+
+    assert client_proc.returncode == 0
+    assert b'User data: OK!' in out
+    assert b'Snapshot #1: OK!' in out
+    assert stub_server.messages == [MSG_TYPES.USER_DATA, MSG_TYPES.SNAPSHOT]
+
+
+def _sample_datetimes():
+    return [60000 + 1000 * i for i in range(LONG_SAMPLE_SNAPSHOTS)]
+
+
+def _assert_all_acked(out):
+    for i in range(1, LONG_SAMPLE_SNAPSHOTS + 1):
+        assert f'Snapshot #{i}: OK!'.encode() in out
+
+
+def test_upload_sample_pipelined(prepare_long_protofile, stub_server):
+    client_proc = capture(f"python -m bci.client upload-sample "
+                          f"-h '127.0.0.1' -p {stub_server.port} -w 4 "
+                          f"{prepare_long_protofile}")
+    out, err = client_proc.communicate()
+
+    assert client_proc.returncode == 0
+    _assert_all_acked(out)
+    # a single session publishes the snapshots in order
+    assert [snapshot.datetime for snapshot in stub_server.snapshots] == \
+        _sample_datetimes()
+
+
+def test_upload_sample_workers(prepare_long_protofile, stub_server):
+    client_proc = capture(f"python -m bci.client upload-sample "
+                          f"-h '127.0.0.1' -p {stub_server.port} -W 3 -w 2 "
+                          f"{prepare_long_protofile}")
+    out, err = client_proc.communicate()
+
+    assert client_proc.returncode == 0
+    _assert_all_acked(out)
+    assert f'Uploaded {LONG_SAMPLE_SNAPSHOTS} snapshots'.encode() in out
+    # workers' sessions are published in whatever order they're served
+    assert sorted(snapshot.datetime for snapshot in stub_server.snapshots) \
+        == _sample_datetimes()
+    assert stub_server.messages.count(MSG_TYPES.USER_DATA) == 1
+
+
+def test_upload_sample_batch(prepare_long_protofile, stub_server):
+    client_proc = capture(f"python -m bci.client upload-sample "
+                          f"-h '127.0.0.1' -p {stub_server.port} -b 4 -w 2 "
+                          f"{prepare_long_protofile}")
+    out, err = client_proc.communicate()
+
+    assert client_proc.returncode == 0
+    _assert_all_acked(out)
+    assert stub_server.batches == [4, 4, 2]
+    assert [snapshot.datetime for snapshot in stub_server.snapshots] == \
+        _sample_datetimes()
+
+
+def test_upload_sample_async_python_api(prepare_long_protofile, stub_server):
+    async def upload_twice():
+        await asyncio.gather(*(
+            upload_sample_async(host='127.0.0.1', port=stub_server.port,
+                                path=str(prepare_long_protofile), window=2)
+            for _ in range(2)))
+    asyncio.run(upload_twice())
+
+    assert sorted(snapshot.datetime for snapshot in stub_server.snapshots) \
+        == sorted(_sample_datetimes() * 2)
+    assert stub_server.messages.count(MSG_TYPES.USER_DATA) == 2
+
+
+def test_upload_sample_resume(prepare_good_protofile, stub_server):
+    # pretend the only snapshot in the file was already acknowledged
+    sample_size = len(gzip.open('tests/good_proto.mind.gz').read())
+    checkpoint = Path('tests/good_proto.mind.gz.checkpoint')
+    checkpoint.write_text(json.dumps({'snapshot': 1, 'offset': sample_size}))
+    client_proc = capture(f"python -m bci.client upload-sample "
+                          f"-h '127.0.0.1' -p {stub_server.port} -r "
+                          f"tests/good_proto.mind.gz")
+    out, err = client_proc.communicate()
+
+    assert client_proc.returncode == 0
+    assert b'User data: OK!' in out
+    assert b'Snapshot #1' not in out
+    assert stub_server.messages == [MSG_TYPES.USER_DATA]
+    assert not checkpoint.exists()
+
+
+def _write_checkpoint(path, snapshots):
+    # pretend the first snapshots in the sample were already acknowledged
+    reader = ProtobufReader(path)
+    with reader:
+        snapshot_reader = reader.read_raw_snapshot()
+        for _ in range(snapshots):
+            next(snapshot_reader)
+        offset = reader.offset
+    checkpoint = Path(f'{path}.checkpoint')
+    checkpoint.write_text(json.dumps({
+        'snapshot': snapshots, 'offset': offset,
+        'datetime': 60000 + 1000 * (snapshots - 1)}))
+    return checkpoint
+
+
+def test_upload_sample_resume_confirmed(prepare_long_protofile, stub_server):
+    # the server holds a later snapshot than the checkpoint's, which
+    #  confirms it without skipping anything past it
+    checkpoint = _write_checkpoint(prepare_long_protofile, 5)
+    snapshot_dir(123, 99000, stub_server.datapath).mkdir(parents=True)
+    upload_sample('127.0.0.1', stub_server.port, prepare_long_protofile,
+                  resume=True)
+
+    assert [snapshot.feelings.hunger for snapshot in stub_server.snapshots] \
+        == pytest.approx([i / LONG_SAMPLE_SNAPSHOTS for i in range(5, 10)])
+    assert not checkpoint.exists()
+
+
+def test_upload_sample_resume_unconfirmed(prepare_long_protofile,
+                                          stub_server):
+    # the server doesn't hold the checkpoint's snapshot, so all are sent
+    checkpoint = _write_checkpoint(prepare_long_protofile, 5)
+    upload_sample('127.0.0.1', stub_server.port, prepare_long_protofile,
+                  resume=True)
+
+    assert [snapshot.feelings.hunger for snapshot in stub_server.snapshots] \
+        == pytest.approx([i / LONG_SAMPLE_SNAPSHOTS for i in range(10)])
+    assert not checkpoint.exists()
+
+
+def test_upload_sample_resume_failed(prepare_long_protofile):
+    # an upload which fails before getting anywhere keeps the checkpoint
+    checkpoint = _write_checkpoint(prepare_long_protofile, 5)
+    saved = checkpoint.read_text()
+    with pytest.raises(ConnectionError):
+        upload_sample('127.0.0.1', _free_port(), prepare_long_protofile,
+                      resume=True)
+
+    assert checkpoint.read_text() == saved
+
+
+def test_upload_sample_binary_read_ahead(stub_server, tmp_path):
+    # there's nothing to read ahead in uncompressed samples, but asking for
+    #  it is fine all the same
+    path = tmp_path / 'sample.mind'
+    with open(path, 'wb') as f:
+        f.write(struct.pack('QI', 42, 3) + b'Dan')
+        f.write(struct.pack('Ic', 699746400, b'm'))
+        f.write(struct.pack('<Q3d4d2I', 60000, 1, 2, 3, .1, .2, .3, .4, 1, 1))
+        f.write(bytes([1, 2, 3]))                           # BGR pixels
+        f.write(struct.pack('<2I4f', 0, 0, .5, .25, 0, -.5))
+    client_proc = capture(f"python -m bci.client upload-sample "
+                          f"-h '127.0.0.1' -p {stub_server.port} "
+                          f"-f binary -a 4 {path}")
+    out, err = client_proc.communicate()
+
+    assert err == b''
+    assert b'Snapshot #1: OK!' in out
+    assert [snapshot.feelings.hunger for snapshot in stub_server.snapshots] \
+        == [.5]
+
+
+def test_upload_sample_compressed(prepare_good_protofile, stub_server):
+    client_proc = capture(f"python -m bci.client upload-sample "
+                          f"-h '127.0.0.1' -p {stub_server.port} "
+                          f"-c unknown,zlib tests/good_proto.mind.gz")
+    out, err = client_proc.communicate()
+
+    assert client_proc.returncode == 0
+    assert b'Snapshot #1: OK!' in out
+    assert [snapshot.feelings.hunger for snapshot in stub_server.snapshots] \
+        == [.5]
+
+
+def test_upload_sample_flat(prepare_long_protofile, stub_server):
+    client_proc = capture(f"python -m bci.client upload-sample "
+                          f"-h '127.0.0.1' -p {stub_server.port} -e flat -w 2 "
+                          f"{prepare_long_protofile}")
+    out, err = client_proc.communicate()
+
+    assert client_proc.returncode == 0
+    _assert_all_acked(out)
+    reader = ProtobufReader(prepare_long_protofile)
+    with reader:
+        snapshots = list(reader.read_snapshot())
+    assert [snapshot.datetime for snapshot in stub_server.snapshots] == \
+        _sample_datetimes()
+    for snapshot, published in zip(snapshots, stub_server.snapshots):
+        # published as sent, without decoding it into a Protobuf message
+        raw_snapshot = FlatSnapshot(snapshot.SerializeToString()).serialize()
+        assert isinstance(published, FlatSnapshot)
+        assert bytes(published.raw_data) == raw_snapshot
+        assert published.feelings.hunger == \
+            pytest.approx(snapshot.feelings.hunger)
+        assert (published.color_image.width, published.color_image.height) \
+            == (snapshot.color_image.width, snapshot.color_image.height)
+        assert bytes(published.color_image.data) == snapshot.color_image.data
+        # the digest saved for it is of the snapshot as sent
+        digest_path = snapshot_dir(123, snapshot.datetime,
+                                   stub_server.datapath) / 'snapshot.sha1'
+        assert digest_path.read_bytes() == \
+            hashlib.sha1(raw_snapshot).digest()
+
+
+def test_upload_sample_dedup(prepare_good_protofile, stub_server):
+    outputs = []
+    for _ in range(2):
+        client_proc = capture(f"python -m bci.client upload-sample "
+                              f"-h '127.0.0.1' -p {stub_server.port} -d "
+                              f"tests/good_proto.mind.gz")
+        out, err = client_proc.communicate()
+        assert client_proc.returncode == 0
+        outputs.append(out)
+
+    # the server's datapath starts out empty, so only the second upload
+    #  skips the snapshot
+    assert b'Snapshot #1: OK!' in outputs[0]
+    assert b'Skipped' not in outputs[0]
+    assert b'Skipped 1 snapshots already on the server' in outputs[1]
+    assert b'Snapshot #1' not in outputs[1]
+    assert stub_server.messages == [MSG_TYPES.USER_DATA, MSG_TYPES.SNAPSHOT,
+                                    MSG_TYPES.USER_DATA]
+
+
+def test_upload_dir(prepare_good_protofile, stub_server, tmp_path):
+    samples = tmp_path / 'samples'
+    samples.mkdir()
+    for name in ('first.mind.gz', 'second.mind.gz'):
+        (samples / name).write_bytes(
+            Path('tests/good_proto.mind.gz').read_bytes())
+    (samples / 'first.mind.gz.checkpoint').write_text('{}')
+    (samples / 'bad.mind.gz').write_bytes(b'garbage data')
+    client_proc = capture(f"python -m bci.client upload-dir -h '127.0.0.1' "
+                          f"-p {stub_server.port} -j 2 -s {samples}")
+    out, err = client_proc.communicate()
+
+    assert f'{samples}/first.mind.gz: 1 snapshots'.encode() in out
+    assert f'{samples}/second.mind.gz: 1 snapshots'.encode() in out
+    assert f'{samples}/bad.mind.gz: ERROR: Not a gzipped file'.encode() \
+        in err
+    assert b'Uploaded 2 snapshots' in out
+    assert b'from 2/3 files' in out
+    assert sorted(stub_server.messages) == [MSG_TYPES.USER_DATA] * 2 + \
+        [MSG_TYPES.SNAPSHOT] * 2
+
+
+def test_send_snapshots_out_of_order(tmp_path):
+    # pipelined acks may arrive in any order within the window; the
+    #  checkpoint only moves past snapshots acked along with all before them
+    client, server = socket.socketpair()
+    snapshots = [(i, Snapshot(123, _raw_snapshot(i)).serialize())
+                 for i in range(1, 11)]
+    checkpoint = Checkpoint(tmp_path / 'sample')
+    for i, _ in snapshots:
+        checkpoint.track(i, 100 * i)
+    positions = []
+    acknowledge = checkpoint.acknowledge
+
+    def record(i):
+        acknowledge(i)
+        positions.append((i, checkpoint.snapshot))
+    checkpoint.acknowledge = record
+
+    def serve():
+        # acks each window's worth of snapshots in reverse
+        connection = Connection(server)
+        with connection:
+            received = 0
+            while received < len(snapshots):
+                window = min(4, len(snapshots) - received)
+                for _ in range(window):
+                    connection.receive_message()
+                for sequence in range(received + window, received, -1):
+                    connection.send_message(
+                        struct.pack('<I', sequence) + b'OK!')
+                received += window
+    thread = threading.Thread(target=serve)
+    thread.start()
+    connection = Connection(client)
+    with connection:
+        assert _send_snapshots(connection, iter(snapshots), window=4,
+                               checkpoint=checkpoint) == \
+            (10, sum(len(packed) for _, packed in snapshots))
+    thread.join()
+    assert positions[:4] == [(4, 0), (3, 0), (2, 0), (1, 4)]
+    assert (checkpoint.snapshot, checkpoint.offset) == (10, 1000)
+
+
+def _serve_once(port, *answers):
+    # answers the first message of each connection in turn, and closes it
+    listener = Listener(port, '127.0.0.1')
+    listener.start()
+
+    def serve():
+        for answer in answers:
+            connection = listener.accept()
+            with connection:
+                connection.receive_message()
+                connection.send_message(answer)
+        listener.stop()
+    thread = threading.Thread(target=serve)
+    thread.start()
+    return thread
+
+
+def test_open_session_fallback():
+    # servers which predate v2 don't know the message type
+    thread = _serve_once(5512, 'ERROR: Unknown message type')
+    connection = _open_session('127.0.0.1', 5512, 123)
+    with connection:
+        assert isinstance(connection, Connection)
+    thread.join()
+
+
+def test_connect_busy():
+    thread = _serve_once(5512, 'BUSY retry-after 0.01', 'OK!')
+    connection, answer = _connect('127.0.0.1', 5512,
+                                  UserData(_User).serialize())
+    with connection:
+        assert answer == b'OK!'
+    thread.join()
+
+
+def _reset(connection):
+    # closes a connection without reading what's left in it, resetting it
+    connection.socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                 struct.pack('ii', 1, 0))
+    connection.close()
+
+
+def test_connect_busy_large_message(monkeypatch):
+    # busy servers answer before reading a (snapshot-sized) first message;
+    #  the first one drains the message, the second one resets the
+    #  connection under the client right after answering
+    monkeypatch.setattr('bci.server.RETRY_AFTER', 0.01)
+    message = bytes(8 * 2**20)
+    listener = Listener(5512, '127.0.0.1')
+    listener.start()
+    received = []
+
+    def serve():
+        _reject(listener.accept())
+        connection = listener.accept()
+        connection.send_message('BUSY retry-after 0.01')
+        _reset(connection)
+        connection = listener.accept()
+        with connection:
+            received.append(connection.receive_message())
+            connection.send_message('OK!')
+        listener.stop()
+    thread = threading.Thread(target=serve)
+    thread.start()
+    connection, answer = _connect('127.0.0.1', 5512, message)
+    with connection:
+        assert answer == b'OK!'
+    thread.join()
+    assert received == [message]
+
+
+def test_connect_reset():
+    # a reset without a busy answer isn't taken for one
+    listener = Listener(5512, '127.0.0.1')
+    listener.start()
+
+    def serve():
+        connection = listener.accept()
+        connection.send_message('ERROR: not now')
+        _reset(connection)
+        listener.stop()
+    thread = threading.Thread(target=serve)
+    thread.start()
+    with pytest.raises((ConnectionResetError, BrokenPipeError)):
+        # more than the sockets' buffers hold, so it's never sent whole
+        _connect('127.0.0.1', 5512, bytes(32 * 2**20))
+    thread.join()
@@ -1,4 +1,5 @@
 import socket
+import struct
 import time
 
 import pytest
@@ -100,3 +101,55 @@ def test_context_manager(server):
 def test_connect(server):
     with Connection.connect('127.0.0.1', _PORT):
         server.accept()
+
+
+def test_receive_message(server):
+    sock = socket.socket()
+    sock.connect(('127.0.0.1', _PORT))
+    connection = Connection(sock)
+    message = _DATA * 2**16
+    try:
+        client, _ = server.accept()
+        # a header split across packets, then a message of several chunks
+        client.sendall(struct.pack('<I', len(message))[:2])
+        time.sleep(0.1)
+        client.sendall(struct.pack('<I', len(message))[2:] + message)
+        client.sendall(struct.pack('<I', len(_DATA)) + _DATA)
+        assert connection.receive_message() == message
+        assert connection.receive_message() == _DATA
+        client.close()
+        with pytest.raises(EOFError):
+            connection.receive_message()
+    finally:
+        connection.close()
+
+
+def test_receive_incomplete_message(server):
+    sock = socket.socket()
+    sock.connect(('127.0.0.1', _PORT))
+    connection = Connection(sock)
+    try:
+        client, _ = server.accept()
+        client.sendall(struct.pack('<I', len(_DATA)) + _DATA[:-1])
+        client.close()
+        with pytest.raises(Exception, match='data is incomplete'):
+            connection.receive_message()
+    finally:
+        connection.close()
+
+
+def test_send_message(server):
+    connection = Connection.connect('127.0.0.1', _PORT, nodelay=True,
+                                    sndbuf=2**20)
+    try:
+        client, _ = server.accept()
+        assert connection.socket.getsockopt(socket.IPPROTO_TCP,
+                                            socket.TCP_NODELAY)
+        message = _DATA * 2**16
+        connection.send_message(memoryview(message)[1:])
+        connection.send_message(_DATA.decode())
+        receiver = Connection(client)
+        assert receiver.receive_message() == message[1:]
+        assert receiver.receive_message() == _DATA
+    finally:
+        connection.close()
@@ -70,3 +70,30 @@ def test_context_manager(listener):
         time.sleep(0.1)
         assert socket.socket().connect_ex((_HOST, _PORT)) == 0
     assert socket.socket().connect_ex((_HOST, _PORT)) != 0
+
+
+def test_socket_options():
+    listener = Listener(_PORT, host=_HOST, nodelay=True, keepalive=True)
+    sock = socket.socket()
+    with listener:
+        time.sleep(0.1)
+        sock.connect((_HOST, _PORT))
+        connection = listener.accept()
+        with connection:
+            assert connection.socket.getsockopt(socket.IPPROTO_TCP,
+                                                socket.TCP_NODELAY)
+            assert connection.socket.getsockopt(socket.SOL_SOCKET,
+                                                socket.SO_KEEPALIVE)
+    sock.close()
+
+
+def test_reuseport():
+    listeners = [Listener(_PORT, host=_HOST, reuseport=True)
+                 for _ in range(2)]
+    for listener in listeners:
+        listener.start()
+    try:
+        assert socket.socket().connect_ex((_HOST, _PORT)) == 0
+    finally:
+        for listener in listeners:
+            listener.stop()
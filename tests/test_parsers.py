@@ -1,7 +1,10 @@
+import json
 import time
 from pathlib import Path
 
 from bci.parsers import run_parser
+from bci.utils import FlatSnapshot
+from bci.utils.protobuf import cortex_pb2
 from conftest import capture, WAIT_INTERVAL
 
 log_path = Path(__file__).parents[1] / "log" / "parsers.log"
@@ -132,3 +135,17 @@ def test_parsers_help():
     assert b'Usage: bci.parsers [OPTIONS] COMMAND [ARGS]' in out
     assert b'parse' in out
     assert b'run-parser' in out
+
+
+def test_parse_flat_snapshot(tmp_path, capsys):
+    snapshot = cortex_pb2.Snapshot()
+    snapshot.datetime = 60000
+    snapshot.feelings.hunger = .5
+    snapshot.feelings.happiness = 1
+    raw_snapshot_path = tmp_path / 'snapshot.raw'
+    raw_snapshot_path.write_bytes(FlatSnapshot(snapshot).serialize())
+    run_parser('feelings', str(raw_snapshot_path))
+    out, err = capsys.readouterr()
+    assert json.loads(out.splitlines()[-1]) == {
+        'id': 60000, 'hunger': .5, 'thirst': 0, 'exhaustion': 0,
+        'happiness': 1}
@@ -0,0 +1,56 @@
+import struct
+
+import numpy as np
+
+from bci.utils import (FlatSnapshot, Frame, Snapshot, UserData, FLAGS,
+                       MSG_TYPES)
+from bci.utils.protobuf import cortex_pb2
+from conftest import _User, _raw_snapshot
+
+
+def test_frame():
+    frame = Frame(MSG_TYPES.SNAPSHOT, 123, b'payload', stream=2, sequence=7,
+                  flags=FLAGS.COMPRESSED)
+    parsed = Frame.deserialize(frame.serialize())
+    assert (parsed.msg_type, parsed.user_id, parsed.stream, parsed.sequence,
+            parsed.flags) == (MSG_TYPES.SNAPSHOT, 123, 2, 7, FLAGS.COMPRESSED)
+    assert parsed.payload == b'payload'
+    wrapped = Frame.from_message(UserData(_User).serialize())
+    assert (wrapped.msg_type, wrapped.user_id) == (MSG_TYPES.USER_DATA, 123)
+    user = cortex_pb2.User()
+    user.ParseFromString(wrapped.payload)
+    assert user.username == 'Test Testenson'
+
+
+def test_snapshot_batch():
+    raw_snapshots = [_raw_snapshot(datetime) for datetime in (1, 2, 3)]
+    message = Snapshot.serialize_batch(123, raw_snapshots)
+    assert struct.unpack_from('<IQ', message) == \
+        (MSG_TYPES.SNAPSHOT_BATCH, 123)
+    assert [bytes(raw_snapshot) for raw_snapshot in
+            Snapshot.split_batch(message[12:])] == raw_snapshots
+    assert [snapshot.datetime for snapshot in
+            Snapshot.deserialize_batch(message[12:])] == [1, 2, 3]
+
+
+def test_flat_snapshot():
+    snapshot = cortex_pb2.Snapshot()
+    snapshot.datetime = 1575446887339
+    snapshot.pose.rotation.w = -4
+    snapshot.color_image.height, snapshot.color_image.width = 2, 3
+    snapshot.color_image.data = bytes(range(18))
+    snapshot.depth_image.height, snapshot.depth_image.width = 3, 1
+    snapshot.depth_image.data.extend([.5, 1, 1.5])
+    snapshot.feelings.happiness = 1
+    raw_snapshot = FlatSnapshot(snapshot.SerializeToString()).serialize()
+    assert Snapshot(123, raw_snapshot).get_datetime() == snapshot.datetime
+
+    flat = Snapshot.deserialize(raw_snapshot)
+    assert (flat.datetime, flat.pose.rotation.w, flat.feelings.happiness) == \
+        (snapshot.datetime, -4, 1)
+    assert bytes(flat.color_image.data) == snapshot.color_image.data
+    assert flat.depth_image.data.tolist() == [.5, 1, 1.5]
+    # the images are views of the snapshot, aligned for numpy
+    assert not flat.depth_image.data.flags.owndata
+    assert np.frombuffer(flat.color_image.data, np.uint8).ctypes.data % 64 == \
+        np.frombuffer(raw_snapshot, np.uint8).ctypes.data % 64
@@ -0,0 +1,219 @@
+import os
+import json
+import threading
+from types import SimpleNamespace
+
+import pika
+import pytest
+
+from bci.publishers import rabbitmq
+from bci.utils import MSG_TYPES
+
+
+class _Broker:
+    ''' Stands in for rabbitmq, behind pika.BlockingConnection '''
+    def __init__(self):
+        self.connections = []
+        self.published, self.commits = [], []
+        self.down = False
+
+    def connect(self, parameters):
+        if self.down:
+            raise pika.exceptions.AMQPConnectionError('connection refused')
+        self.connections.append(_Connection(self))
+        return self.connections[-1]
+
+
+class _Connection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self.stale = False          # closed by the broker while idle
+        self.drop_after = None      # messages published before it's lost
+        self.drop_at_commit = False
+
+    def channel(self):
+        return _Channel(self)
+
+    def process_data_events(self, time_limit=0):
+        if self.stale:
+            self.is_open = False
+            raise pika.exceptions.ConnectionClosedByBroker(320, 'idle')
+
+    def drop(self):
+        self.is_open = False
+        raise pika.exceptions.StreamLostError('connection lost')
+
+    def close(self):
+        self.is_open = False
+
+
+class _Channel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.transaction = None
+
+    def exchange_declare(self, exchange, exchange_type):
+        pass
+
+    def tx_select(self):
+        self.transaction = []
+
+    def basic_publish(self, exchange, routing_key, body):
+        if self.connection.drop_after == 0:
+            self.connection.drop()
+        if self.connection.drop_after is not None:
+            self.connection.drop_after -= 1
+        if self.transaction is None:
+            self.connection.broker.published.append(body)
+        else:
+            self.transaction.append(body)
+
+    def tx_commit(self):
+        if self.connection.drop_at_commit:
+            self.connection.drop()
+        self.connection.broker.published.extend(self.transaction)
+        self.connection.broker.commits.append(len(self.transaction))
+        self.transaction = []
+
+
+@pytest.fixture
+def broker(monkeypatch):
+    broker = _Broker()
+    monkeypatch.setattr(pika, 'BlockingConnection', broker.connect)
+    rabbitmq._forget_publishers()
+    yield broker
+    rabbitmq._forget_publishers()
+
+
+def _user(user_id):
+    return SimpleNamespace(user_id=user_id, username='Test Testenson',
+                           birthdate=0, gender=0)
+
+
+def _kwargs(user_id=123, **kwargs):
+    return {'publisher_host': '127.0.0.1', 'publisher_port': 5672,
+            'msg_type': MSG_TYPES.USER_DATA, 'user_id': user_id, **kwargs}
+
+
+def _user_ids(published):
+    return sorted(json.loads(body)['user_id'] for body in published)
+
+
+def _publish_concurrently(count, **kwargs):
+    # publishes a user per thread, returning what each publishing raised
+    errors = [None] * count
+
+    def publish(i):
+        try:
+            rabbitmq.publish(_user(i), **_kwargs(i, **kwargs))
+        except Exception as error:
+            errors[i] = error
+    threads = [threading.Thread(target=publish, args=(i,))
+               for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def _snapshot(tmp_path, datetime):
+    # spooled by the server already, so it isn't saved again
+    return SimpleNamespace(datetime=datetime,
+                           path=tmp_path / str(datetime) / 'snapshot.raw')
+
+
+def test_publish_reuse(broker):
+    # a publisher (and its connection) is reused once it's idle, so there
+    #  are only as many as messages published at once
+    for i in range(10):
+        rabbitmq.publish(_user(i), **_kwargs(i))
+    assert len(broker.connections) == 1
+    assert _publish_concurrently(8) == [None] * 8
+    assert len(broker.connections) <= 8
+    assert len(rabbitmq._pools[('127.0.0.1', 5672)]) == \
+        len(broker.connections)
+    assert _user_ids(broker.published) == sorted(list(range(10)) +
+                                                 list(range(8)))
+
+
+def test_publish_stale(broker):
+    # a connection closed by the broker while idle is replaced before
+    #  publishing over it
+    rabbitmq.publish(_user(1), **_kwargs(1))
+    broker.connections[-1].stale = True
+    rabbitmq.publish(_user(2), **_kwargs(2))
+    assert len(broker.connections) == 2
+    assert _user_ids(broker.published) == [1, 2]
+
+
+def test_publish_lost_midway(broker, tmp_path):
+    # a connection lost between the two messages published for a snapshot
+    #  carries on from the second one, over a new connection
+    rabbitmq.publish(_user(1), **_kwargs(1))
+    broker.connections[-1].drop_after = 1
+    rabbitmq.publish_batch(
+        [_snapshot(tmp_path, 60000), _snapshot(tmp_path, 61000)],
+        **_kwargs(msg_type=MSG_TYPES.SNAPSHOT))
+    assert len(broker.connections) == 2
+    assert len(broker.published) == 5
+    assert len(set(broker.published)) == 5
+
+
+def test_publish_fork(broker):
+    # forked processes don't share their parent's connections
+    rabbitmq.publish(_user(1), **_kwargs(1))
+    assert rabbitmq._pools
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if not rabbitmq._pools else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+def test_publish_commit_batch(broker):
+    errors = _publish_concurrently(8, publisher_commit='1',
+                                   publisher_batch='4',
+                                   publisher_linger='1000')
+    assert errors == [None] * 8
+    assert broker.commits == [4, 4]
+    assert _user_ids(broker.published) == list(range(8))
+    assert len(broker.connections) == 1
+
+
+def test_publish_commit_linger(broker):
+    # a lone message is committed once the burst stops lingering
+    kwargs = _kwargs(1, publisher_commit='true', publisher_linger='10')
+    rabbitmq.publish(_user(1), **kwargs)
+    assert broker.commits == [1]
+
+
+def test_publish_commit_flag(broker):
+    rabbitmq.publish(_user(1), **_kwargs(1, publisher_commit='false'))
+    rabbitmq.publish(_user(2), **_kwargs(2, publisher_commit='0'))
+    assert broker.commits == []
+    assert _user_ids(broker.published) == [1, 2]
+    with pytest.raises(ValueError):
+        rabbitmq.publish(_user(3), **_kwargs(3, publisher_commit='maybe'))
+
+
+def test_publish_commit_lost(broker):
+    # a burst whose connection is lost before the commit is published again
+    #  in whole, over a new connection
+    rabbitmq.publish(_user(0), **_kwargs(0, publisher_commit='1'))
+    broker.connections[-1].drop_at_commit = True
+    errors = _publish_concurrently(4, publisher_commit='1')
+    assert errors == [None] * 4
+    assert _user_ids(broker.published) == [0, 0, 1, 2, 3]
+    assert len(broker.connections) == 2
+
+
+def test_publish_commit_error(broker):
+    # every message of a burst which can't be published gets the error
+    broker.down = True
+    errors = _publish_concurrently(4, publisher_commit='1',
+                                   publisher_batch='4',
+                                   publisher_linger='1000')
+    assert all(isinstance(error, ConnectionError) for error in errors)
+    assert broker.published == []
@@ -0,0 +1,207 @@
+import gzip
+import struct
+
+import pytest
+from google.protobuf.message import DecodeError
+
+from bci.client import convert_sample
+from bci.readers.binary import BinaryReader
+from bci.readers.mapped import MappedProtobufReader
+from bci.readers.mindx import INDEX_ENTRY, TRAILER, MindxReader
+from bci.readers.protobuf import ProtobufReader, build_index, load_index, \
+    indexed_gzip, reader_cls
+from bci.utils.protobuf import cortex_pb2
+from conftest import LONG_SAMPLE_SNAPSHOTS
+
+
+def _read_sequentially(path):
+    reader = ProtobufReader(path)
+    with reader:
+        return list(reader.read_snapshot())
+
+
+def _check_random_access(reader, snapshots):
+    # snapshots read by index match those read one after the other
+    middle = len(snapshots) // 2
+    assert len(reader) == len(snapshots)
+    assert reader[middle] == snapshots[middle]
+    assert reader[-1] == snapshots[-1]
+    assert reader[0] == snapshots[0]
+    assert list(reader.read_snapshots(middle, middle + 3)) == \
+        snapshots[middle:middle + 3]
+    assert list(reader.read_snapshots(middle)) == snapshots[middle:]
+    assert list(reader.read_snapshots(len(snapshots))) == []
+
+
+def test_protobuf_random_access(prepare_long_protofile):
+    snapshots = _read_sequentially(prepare_long_protofile)
+    assert len(snapshots) == LONG_SAMPLE_SNAPSHOTS
+    reader = ProtobufReader(prepare_long_protofile)
+    with reader:
+        _check_random_access(reader, snapshots)
+
+
+def test_protobuf_build_index(prepare_long_protofile):
+    snapshots = _read_sequentially(prepare_long_protofile)
+    index = build_index(prepare_long_protofile)
+    assert len(index) == LONG_SAMPLE_SNAPSHOTS
+    assert load_index(prepare_long_protofile) == index
+    reader = ProtobufReader(prepare_long_protofile)
+    with reader:
+        assert reader.index == index
+        # seeking starts from the saved seek points, where available
+        if indexed_gzip:
+            assert isinstance(reader.fp, indexed_gzip.IndexedGzipFile)
+        _check_random_access(reader, snapshots)
+
+
+def test_protobuf_stale_index(prepare_long_protofile):
+    snapshots = _read_sequentially(prepare_long_protofile)
+    build_index(prepare_long_protofile)
+    prepare_long_protofile.touch()
+    assert load_index(prepare_long_protofile) is None
+    # neither stale index is used
+    reader = ProtobufReader(prepare_long_protofile)
+    with reader:
+        assert reader.index is None
+        assert not isinstance(reader.fp, indexed_gzip.IndexedGzipFile
+                              if indexed_gzip else ())
+        _check_random_access(reader, snapshots)
+
+
+def test_protobuf_raw_snapshots(prepare_long_protofile):
+    # raw snapshots are the stored bytes of the snapshots, found at the same
+    #  offsets as the parsed ones
+    expected = ProtobufReader(prepare_long_protofile)
+    with expected:
+        snapshots = [(snapshot.SerializeToString(), expected.offset)
+                     for snapshot in expected.read_snapshot()]
+    reader = ProtobufReader(prepare_long_protofile)
+    with reader:
+        raw_snapshots = [(raw_snapshot, reader.offset)
+                         for raw_snapshot in reader.read_raw_snapshot()]
+    assert len(raw_snapshots) == LONG_SAMPLE_SNAPSHOTS
+    assert raw_snapshots == snapshots
+
+
+def _write_sample(path, *records):
+    user = cortex_pb2.User()
+    user.user_id = 123
+    with gzip.GzipFile(path, 'wb') as f:
+        for record in (user.SerializeToString(),) + records:
+            f.write(struct.pack('I', len(record)) + record)
+
+
+def test_protobuf_raw_corrupt(tmp_path):
+    # raw snapshots aren't parsed, so a corrupt one is read as it is (and
+    #  left for the server to reject)
+    snapshot = cortex_pb2.Snapshot()
+    snapshot.datetime = 60000
+    path = tmp_path / 'corrupt.mind.gz'
+    _write_sample(path, b'\xff' * 10, snapshot.SerializeToString())
+    reader = ProtobufReader(path)
+    with reader:
+        assert list(reader.read_raw_snapshot()) == \
+            [b'\xff' * 10, snapshot.SerializeToString()]
+    reader = ProtobufReader(path)
+    with reader:
+        with pytest.raises(DecodeError):
+            list(reader.read_snapshot())
+
+
+def test_protobuf_raw_truncated(tmp_path):
+    path = tmp_path / 'truncated.mind.gz'
+    _write_sample(path, b'snapshot')
+    with gzip.open(path) as f:
+        data = f.read()
+    with gzip.GzipFile(path, 'wb') as f:
+        f.write(data[:-1])
+    reader = ProtobufReader(path)
+    with reader:
+        with pytest.raises(Exception, match='snapshot data is incomplete'):
+            list(reader.read_raw_snapshot())
+
+
+def test_protobuf_read_ahead(prepare_long_protofile):
+    expected = ProtobufReader(prepare_long_protofile)
+    with expected:
+        snapshots = [(snapshot, expected.offset)
+                     for snapshot in expected.read_snapshot()]
+    assert len(snapshots) > 4
+    reader = ProtobufReader(prepare_long_protofile, read_ahead=4)
+    with reader:
+        assert [(snapshot, reader.offset)
+                for snapshot in reader.read_snapshot()] == snapshots
+
+
+def test_protobuf_uncompressed(prepare_good_protofile, tmp_path):
+    path = tmp_path / 'good_proto.mind'
+    with gzip.open('tests/good_proto.mind.gz') as f:
+        path.write_bytes(f.read())
+    expected = ProtobufReader('tests/good_proto.mind.gz')
+    with expected:
+        raw_snapshots = list(expected.read_raw_snapshot())
+    reader = reader_cls(path, read_ahead=4)
+    assert isinstance(reader, MappedProtobufReader)
+    assert reader.read_ahead == 0
+    with reader:
+        assert reader.user_id == expected.user_id
+        snapshots = list(reader.read_raw_snapshot())
+        assert all(isinstance(data, memoryview) for data in snapshots)
+        assert [bytes(data) for data in snapshots] == raw_snapshots
+        assert reader.offset == path.stat().st_size
+        assert len(reader) == 1
+        assert reader[0].datetime == 60000
+
+
+def test_binary_reader(tmp_path):
+    path = tmp_path / 'sample.mind'
+    with open(path, 'wb') as f:
+        f.write(struct.pack('QI', 42, 3) + b'Dan')
+        f.write(struct.pack('Ic', 699746400, b'm'))
+        f.write(struct.pack('<Q3d4d2I', 60000, 1, 2, 3, .1, .2, .3, .4, 1, 2))
+        f.write(bytes([1, 2, 3, 4, 5, 6]))                  # BGR pixels
+        f.write(struct.pack('<2I4f', 2, 2, 0, .5, 1, 1.5))
+        f.write(struct.pack('<4f', .5, .25, 0, -.5))
+    reader = BinaryReader(path)
+    with reader:
+        assert (reader.user_id, reader.username, reader.gender) == \
+            (42, 'Dan', 'male')
+        snapshot, = reader.read_snapshot()
+    assert snapshot.datetime == 60000
+    assert snapshot.pose.rotation.w == .4
+    assert snapshot.color_image.data == bytes([3, 2, 1, 6, 5, 4])
+    assert list(snapshot.depth_image.data) == [0, .5, 1, 1.5]
+    assert snapshot.feelings.happiness == -.5
+
+
+def test_mindx_convert(prepare_good_protofile, tmp_path):
+    path = tmp_path / 'good_proto.mindx'
+    assert convert_sample('tests/good_proto.mind.gz', str(path)) == 1
+    expected = ProtobufReader('tests/good_proto.mind.gz')
+    with expected:
+        raw_snapshots = list(expected.read_raw_snapshot())
+    for workers in (1, 2):
+        reader = MindxReader(path, workers=workers)
+        with reader:
+            assert (reader.user_id, reader.gender) == \
+                (expected.user_id, expected.gender)
+            assert len(reader) == 1
+            assert reader.datetimes() == [60000]
+            assert reader[0].feelings.hunger == .5
+            assert list(reader.read_raw_snapshot()) == raw_snapshots
+            offset = reader.offset
+            reader.seek(offset)
+            assert list(reader.read_raw_snapshot()) == []
+
+
+def test_mindx_corrupt_block(prepare_good_protofile, tmp_path):
+    path = tmp_path / 'good_proto.mindx'
+    convert_sample('tests/good_proto.mind.gz', str(path))
+    data = bytearray(path.read_bytes())
+    index_offset, _, _ = TRAILER.unpack_from(data, len(data) - TRAILER.size)
+    data[index_offset + INDEX_ENTRY.size - 1] ^= 0xff     # the crc32
+    path.write_bytes(data)
+    reader = MindxReader(path)
+    with reader, pytest.raises(Exception, match='is corrupt'):
+        reader[0]
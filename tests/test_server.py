@@ -1,9 +1,23 @@
+import os
 import time
+import signal
+import socket
+import struct
+import asyncio
 import threading
 from pathlib import Path
 
-from bci.server import run_server
-from conftest import capture, WAIT_INTERVAL
+import pytest
+from furl import furl
+
+from bci.client import upload_sample, _send_snapshots
+from bci.server import (AsyncHandler, Session, run_server, _publisher_args,
+                        _reject)
+from bci.utils import (AsyncConnection, Compression, Connection, EndSession,
+                       FramedConnection, Frame, Hello, Snapshot, UserData,
+                       FRAME_HEADER, FLAGS, MSG_TYPES, PROTOCOL_VERSION)
+from bci.utils.protobuf import cortex_pb2
+from conftest import capture, _User, _raw_snapshot, WAIT_INTERVAL
 
 log_path = Path(__file__).parents[1] / "log" / "server.log"
 
@@ -25,11 +39,12 @@ def test_run_server(prepare_good_protofile, capsys):
     server_proc.terminate()
 
 
-def test_run_server_python_api(prepare_good_protofile):
+def test_run_server_python_api(prepare_good_protofile, tmp_path):
     publisher = __import__('bci.publishers.rabbitmq', globals(), locals(),
                            'rabbitmq')
     server_proc = threading.Thread(target=run_server, args=(), kwargs={
         'host': '127.0.0.1', 'port': 5502, 'publish': publisher.publish,
+        'datapath': tmp_path,
         'publisher_host': '127.0.0.1', 'publisher_port': 5672
     }, daemon=True)
     server_proc.start()
@@ -45,11 +60,12 @@ def test_run_server_python_api(prepare_good_protofile):
     assert 'Sent to snapshots topic: {"id":' in log[-1]
 
 
-def test_run_server_custom_publisher_func(prepare_good_protofile):
+def test_run_server_custom_publisher_func(prepare_good_protofile, tmp_path):
     def log_message(message, **kwargs):
         print(message, file=open('custom_publisher_test.log', 'a'))
     server_proc = threading.Thread(target=run_server, args=(), kwargs={
-        'host': '127.0.0.1', 'port': 5501, 'publish': log_message
+        'host': '127.0.0.1', 'port': 5501, 'publish': log_message,
+        'datapath': tmp_path
     }, daemon=True)
     server_proc.start()
     time.sleep(WAIT_INTERVAL)
@@ -63,6 +79,94 @@ def test_run_server_custom_publisher_func(prepare_good_protofile):
     assert 'utils.protocol.Snapshot object' in log
 
 
+def test_run_server_asyncio(prepare_good_protofile, tmp_path):
+    published = []
+    server_proc = threading.Thread(target=run_server, args=(), kwargs={
+        'host': '127.0.0.1', 'port': 5511, 'use_asyncio': True,
+        'datapath': tmp_path,
+        'publish': lambda message, **kwargs: published.append(
+            kwargs['msg_type'])
+    }, daemon=True)
+    server_proc.start()
+    time.sleep(WAIT_INTERVAL)
+    # both a connection per message, and a session over a single one
+    snapshots, _ = upload_sample('127.0.0.1', 5511,
+                                 'tests/good_proto.mind.gz')
+    session_snapshots, _ = upload_sample('127.0.0.1', 5511,
+                                         'tests/good_proto.mind.gz', window=4)
+    assert snapshots == session_snapshots == 1
+    assert published == [MSG_TYPES.USER_DATA, MSG_TYPES.SNAPSHOT] * 2
+
+
+def test_run_server_busy(tmp_path):
+    server_proc = threading.Thread(target=run_server, args=(), kwargs={
+        'host': '127.0.0.1', 'port': 5513, 'handlers': 1, 'queue_size': 1,
+        'datapath': tmp_path,
+        'publish': lambda message, **kwargs: None
+    }, daemon=True)
+    server_proc.start()
+    time.sleep(WAIT_INTERVAL)
+    hello = Hello(123).serialize()
+    # the first connection is served, the second waits for it to end, and
+    #  the third is turned away
+    connections = [Connection.connect('127.0.0.1', 5513)]
+    connections[0].send_message(hello)
+    assert connections[0].receive_message() == b'2'
+    for _ in range(2):
+        connections.append(Connection.connect('127.0.0.1', 5513))
+        connections[-1].send_message(hello)
+    assert connections[2].receive_message() == b'BUSY retry-after 1'
+    connections[0].close()
+    assert connections[1].receive_message() == b'2'
+    connections[1].close()
+    connections[2].close()
+
+
+def _children(pid):
+    return {int(child) for task in Path(f'/proc/{pid}/task').iterdir()
+            for child in (task / 'children').read_text().split()}
+
+
+def _running(pid):
+    # exited processes are only zombies until their new parent reaps them
+    status = Path(f'/proc/{pid}/status')
+    return status.exists() and '\nState:\tZ' not in status.read_text()
+
+
+def _hello(port):
+    connection = Connection.connect('127.0.0.1', port)
+    with connection:
+        connection.send_message(Hello(123).serialize())
+        return connection.receive_message()
+
+
+def test_run_server_processes(tmp_path):
+    # saying hello publishes nothing, so no message queue is needed
+    server_proc = capture(f"python -m bci.server run-server -h '127.0.0.1' "
+                          f"-p 5514 -P 2 -d {tmp_path} "
+                          f"'rabbitmq://127.0.0.1:5672/'")
+    try:
+        time.sleep(2 * WAIT_INTERVAL)
+        workers = _children(server_proc.pid)
+        assert len(workers) == 2
+        assert _hello(5514) == b'2'
+
+        # workers which die are replaced
+        killed = workers.pop()
+        os.kill(killed, signal.SIGKILL)
+        time.sleep(2 * WAIT_INTERVAL)
+        workers = _children(server_proc.pid)
+        assert len(workers) == 2 and killed not in workers
+        assert _hello(5514) == b'2'
+    finally:
+        server_proc.terminate()
+        server_proc.wait()
+
+    # and exit along with the supervisor
+    time.sleep(2 * WAIT_INTERVAL)
+    assert not any(_running(pid) for pid in workers)
+
+
 def test_run_server_no_publisher_func(prepare_good_protofile, capsys):
     run_server()
     out, err = capsys.readouterr()
@@ -161,3 +265,236 @@ def test_server_help():
     assert server_proc.returncode == 0
     assert b'Usage: bci.server [OPTIONS] COMMAND [ARGS]' in out
     assert b'run-server' in out
+
+
+def test_publisher_args():
+    url = furl('rabbitmq://127.0.0.1:5672/?commit=1&linger=10&user=guest')
+    assert _publisher_args(url) == {'publisher_commit': '1',
+                                    'publisher_linger': '10'}
+
+
+def _start_session(tmp_path, publish, publish_batch=None):
+    # serves a session from a thread, as the threaded server does
+    client, server = socket.socketpair()
+    session = Session(Connection(server), tmp_path, publish, publish_batch)
+    thread = threading.Thread(target=session.run)
+    thread.start()
+    return Connection(client), session, thread
+
+
+def _publish_kwargs(published):
+    return lambda message, **kwargs: published.append(kwargs)
+
+
+def _publish_messages(published):
+    return lambda message, **kwargs: published.append(message)
+
+
+def test_session_v1(tmp_path):
+    published = []
+    connection, _, thread = _start_session(
+        tmp_path, _publish_kwargs(published))
+    with connection:
+        connection.send_message(UserData(_User).serialize())
+        assert connection.receive_message() == b'OK!'
+    thread.join()
+    assert len(published) == 1
+
+
+def test_session_v2(tmp_path):
+    published = []
+    connection, _, thread = _start_session(
+        tmp_path, _publish_kwargs(published))
+    with connection:
+        connection.send_message(Hello(123).serialize())
+        assert connection.receive_message() == str(PROTOCOL_VERSION).encode()
+        framed = FramedConnection(connection, stream=5)
+        framed.send_message(UserData(_User).serialize(), sequence=9)
+        ack = Frame.deserialize(connection.receive_message())
+        assert (ack.msg_type, ack.user_id, ack.stream, ack.sequence) == \
+            (MSG_TYPES.ACK, 123, 5, 9)
+        assert ack.payload == b'OK!'
+        framed.send_message(struct.pack('<IQ', 42, 123), sequence=10)
+        assert framed.receive_message() == \
+            struct.pack('<I', 10) + b'ERROR: Unknown message type'
+    thread.join()
+    assert [kwargs['msg_type'] for kwargs in published] == \
+        [MSG_TYPES.USER_DATA]
+
+
+def test_session_unparsed(tmp_path):
+    # errors answering frames which can't be parsed carry their stream and
+    #  sequence number; frames without even a header end the session
+    connection, _, thread = _start_session(tmp_path, lambda message, **_: None)
+    with connection:
+        connection.send_message(Hello(123).serialize())
+        connection.receive_message()
+        connection.send_message(FRAME_HEADER.pack(
+            PROTOCOL_VERSION + 1, 0, MSG_TYPES.SNAPSHOT, 5, 9, 123))
+        ack = Frame.deserialize(connection.receive_message())
+        assert (ack.msg_type, ack.user_id, ack.stream, ack.sequence) == \
+            (MSG_TYPES.ACK, 123, 5, 9)
+        assert ack.payload == b'ERROR deserializing message'
+        connection.send_message(b'frame')
+        thread.join()
+        with pytest.raises(EOFError):
+            connection.receive_message()
+
+
+def test_session_batch(tmp_path):
+    published, batches = [], []
+    connection, _, thread = _start_session(
+        tmp_path, _publish_kwargs(published),
+        lambda messages, **kwargs: batches.append(len(messages)))
+    with connection:
+        connection.send_message(Hello(123).serialize())
+        connection.receive_message()
+        framed = FramedConnection(connection)
+        raw_snapshots = [_raw_snapshot(1), b'not a snapshot', _raw_snapshot(2)]
+        framed.send_message(Snapshot.serialize_batch(123, raw_snapshots),
+                            sequence=1, flags=FLAGS.BATCH)
+        # one byte per snapshot, telling whether it was published
+        assert framed.receive_message() == struct.pack('<I', 1) + b'\1\0\1'
+    thread.join()
+    assert (published, batches) == ([], [2])
+
+
+def test_session_chunks(tmp_path):
+    published = []
+    connection, _, thread = _start_session(tmp_path,
+                                           _publish_messages(published))
+    snapshot = cortex_pb2.Snapshot()
+    snapshot.datetime = 1575446887339
+    snapshot.color_image.data = bytes(range(256)) * 4
+    raw_snapshot = snapshot.SerializeToString()
+    with connection:
+        connection.send_message(Hello(123).serialize())
+        connection.receive_message()
+        framed = FramedConnection(connection)
+        framed.send_message(Compression(123, ['zlib']).serialize())
+        assert framed.receive_message() == b'zlib'
+        assert _send_snapshots(framed, iter([(1, Snapshot(
+            123, raw_snapshot).serialize())]), codec='zlib',
+            chunk_size=100) == (1, len(raw_snapshot) + 12)
+    thread.join()
+    # the snapshot's spooled into its raw snapshot file, and published as is
+    message, = published
+    assert message.datetime == snapshot.datetime
+    assert message.path.read_bytes() == raw_snapshot
+    assert sorted(path.name for path in message.path.parent.iterdir()) == \
+        ['snapshot.raw', 'snapshot.sha1']
+
+
+def test_session_chunks_discarded(tmp_path):
+    # a client which goes away halfway through a chunked snapshot leaves
+    #  nothing that would pass for a received snapshot
+    connection, session, thread = _start_session(
+        tmp_path, lambda message, **kwargs: None)
+    snapshot = cortex_pb2.Snapshot()
+    snapshot.datetime = 1575446887339
+    snapshot.color_image.data = bytes(range(256)) * 4
+    chunks = Snapshot.serialize_chunks(
+        Snapshot(123, snapshot.SerializeToString()).serialize(), 100)
+    with connection:
+        connection.send_message(Hello(123).serialize())
+        connection.receive_message()
+        framed = FramedConnection(connection)
+        for _ in range(2):
+            chunk, _ = next(chunks)
+            framed.send_message(chunk, sequence=1, flags=FLAGS.MORE)
+    thread.join()
+    assert session.last_snapshot(123) == 0
+    assert list((tmp_path / '123').iterdir()) == []
+
+
+def _chunks(datetime, size=1024, chunk_size=100):
+    snapshot = cortex_pb2.Snapshot()
+    snapshot.datetime = datetime
+    snapshot.color_image.data = bytes(range(256)) * (size // 256)
+    raw_snapshot = snapshot.SerializeToString()
+    return raw_snapshot, Snapshot.serialize_chunks(
+        Snapshot(123, raw_snapshot).serialize(), chunk_size)
+
+
+def test_session_chunks_ended(tmp_path):
+    # a session ended halfway through a chunked snapshot doesn't leave it
+    #  spooled
+    published = []
+    connection, session, thread = _start_session(
+        tmp_path, _publish_kwargs(published))
+    _, chunks = _chunks(1575446887339)
+    with connection:
+        connection.send_message(Hello(123).serialize())
+        connection.receive_message()
+        framed = FramedConnection(connection)
+        for _ in range(2):
+            chunk, _ = next(chunks)
+            framed.send_message(chunk, sequence=1, flags=FLAGS.MORE)
+        framed.send_message(EndSession(123).serialize())
+        thread.join()
+    assert published == []
+    assert list(tmp_path.rglob('*.part')) == []
+    assert session.spools == {}
+
+
+def test_session_chunks_streams(tmp_path):
+    # chunked snapshots sent over different streams at once are spooled
+    #  apart
+    published = []
+    connection, _, thread = _start_session(tmp_path,
+                                           _publish_messages(published))
+    snapshots = [_chunks(1575446887339 + i) for i in range(2)]
+    with connection:
+        connection.send_message(Hello(123).serialize())
+        connection.receive_message()
+        streams = [FramedConnection(connection, stream) for stream in (1, 2)]
+        for chunks in zip(*(chunks for _, chunks in snapshots)):
+            for framed, (chunk, more) in zip(streams, chunks):
+                framed.send_message(chunk, sequence=1,
+                                    flags=FLAGS.MORE if more else 0)
+        for framed in streams:
+            assert framed.receive_message() == struct.pack('<I', 1) + b'OK!'
+    thread.join()
+    assert [message.path.read_bytes() for message in published] == \
+        [raw_snapshot for raw_snapshot, _ in snapshots]
+
+
+def test_reject_large_message():
+    # the client gets to send all of its first message, and read the answer
+    client, server = socket.socketpair()
+    _reject(Connection(server))
+    connection = Connection(client)
+    with connection:
+        connection.send_message(bytes(8 * 2**20))
+        assert connection.receive_message().startswith(b'BUSY')
+
+
+@pytest.mark.parametrize('use_asyncio', [False, True])
+def test_session_fail(use_asyncio):
+    # an unreachable publisher service is reported to the client, and then
+    #  the serving loop (a thread's or the event loop's) ends the process
+    def publish(message, **kwargs):
+        raise ConnectionError('no publisher')
+
+    async def serve_async(sock):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await AsyncHandler(AsyncConnection(reader, writer), None,
+                           publish).serve_async()
+    client, server = socket.socketpair()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            client.close()
+            if use_asyncio:
+                asyncio.run(serve_async(server))
+            else:
+                Session(Connection(server), None, publish).run()
+        finally:
+            os._exit(0)
+    server.close()
+    connection = Connection(client)
+    with connection:
+        connection.send_message(UserData(_User).serialize())
+        assert connection.receive_message() == b'ERROR: no publisher'
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 1